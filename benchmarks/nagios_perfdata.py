@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Micro benchmark of the perfdata parser of the nagios wrapper
+
+Usage: ./benchmarks/nagios_perfdata.py [--metrics 10000] [--repeat 20]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from plugins.wrapper import nagios  # noqa: E402
+
+
+def build_output(metrics):
+    perfdata = []
+    for i in range(metrics):
+        if i % 4 == 0:
+            perfdata.append(f"'disk usage {i}'={i * 7}MB;{i * 8};{i * 9};0;{i * 10}")
+        elif i % 4 == 1:
+            perfdata.append(f"rta_{i}={i / 7:.3f}ms;100.000;500.000;0;")
+        elif i % 4 == 2:
+            perfdata.append(f"'load {i}'={i % 13}.{i % 100};@10:20;~:30")
+        else:
+            # Malformed min and max of third party plugins are skipped
+            perfdata.append(f"odd_{i}={i};;;abc;1.2.3")
+    lines = ["CHECK OK - synthetic output | " + " ".join(perfdata[:metrics // 2])]
+    lines.extend(f"long text line {i}" for i in range(50))
+    lines.append("last long text line | " + perfdata[metrics // 2])
+    lines.extend(perfdata[metrics // 2 + 1:])
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--metrics", type=int, default=10000, help="Number of metrics. (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=20, help="Number of parser runs. (default: %(default)s)")
+    config = parser.parse_args()
+
+    output = build_output(config.metrics)
+    text, perfdata = nagios.parse_output(output)
+    assert len(perfdata) == config.metrics, len(perfdata)
+    assert all(x["min"] is None and x["max"] is None for x in perfdata if x["label"].startswith("odd_"))
+
+    timings = []
+    for _ in range(config.repeat):
+        start = time.perf_counter()
+        nagios.parse_output(output)
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    print(f"metrics: {config.metrics}, bytes: {len(output)}")
+    print(f"best: {best * 1000:.2f} ms, median: {sorted(timings)[len(timings) // 2] * 1000:.2f} ms")
+    print(f"throughput: {len(output) / best / 1024 / 1024:.1f} MiB/s, {config.metrics / best:.0f} metrics/s")
+
+
+if __name__ == '__main__':
+    main()
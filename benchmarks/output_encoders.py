@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Micro benchmark of the output encoders of utils
+
+Usage: ./benchmarks/output_encoders.py [--datasets 50] [--repeat 20000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils  # noqa: E402
+
+
+def build_result(datasets):
+    return utils.build_result(
+        state=utils.OutputState.WARN,
+        output="Synthetic output\nwith a second line",
+        datasets=[
+            utils.build_dataset(name=f"metric {i}", value=i / 7, unit="ms", warning=100, critical=500, minimum=0)
+            for i in range(datasets)
+        ]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--datasets", type=int, default=50, help="Datasets per result. (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=20000, help="Results encoded per format. (default: %(default)s)")
+    config = parser.parse_args()
+
+    result = build_result(config.datasets)
+    for output_format in utils.OUTPUT_FORMATS:
+        try:
+            utils.set_output_format(output_format)
+        except ValueError as err:
+            print(f"{output_format:8} skipped: {err}")
+            continue
+        encoded = utils.encode_result(result)
+        start = time.perf_counter()
+        for _ in range(config.repeat):
+            utils.encode_result(result)
+        elapsed = time.perf_counter() - start
+        print(f"{output_format:8} {elapsed / config.repeat * 1e6:8.1f} us/result, {len(encoded):6} bytes")
+
+
+if __name__ == '__main__':
+    main()
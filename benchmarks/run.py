@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""Benchmark suite of the launcher and the shipped plugins
+
+Usage: ./benchmarks/run.py [--output bench_results.json] [--only cold_start imports traverse checks batch]
+       ./benchmarks/run.py --compare old.json new.json
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import q_plugins  # noqa: E402
+import utils  # noqa: E402
+from benchmarks import standins  # noqa: E402
+
+LAUNCHER = os.path.join(ROOT, "q_plugins.py")
+GROUPS = ["cold_start", "imports", "traverse", "checks", "batch"]
+
+
+def summarize(name, timings, **extra):
+    ordered = sorted(timings)
+    total = sum(ordered)
+    return {
+        "name": name,
+        "iterations": len(ordered),
+        "min": ordered[0],
+        "p50": ordered[len(ordered) // 2],
+        "p95": ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)],
+        "max": ordered[-1],
+        "mean": total / len(ordered),
+        "throughput": len(ordered) / total if total else None,
+        **extra,
+    }
+
+
+def measure(func, iterations, warmup=1):
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run_launcher(*args, stdin=None):
+    return subprocess.run(
+        [sys.executable, LAUNCHER, *args], cwd=ROOT, input=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+
+
+def bench_cold_start(config):
+    results = [summarize(
+        "cold_start/interpreter",
+        measure(lambda: subprocess.run([sys.executable, "-c", "pass"]), config.cli_iterations)
+    )]
+    for plugin, args in [("example.example", ["--hostaddress", "localhost"])]:
+        results.append(summarize(
+            f"cold_start/{plugin}", measure(lambda: run_launcher("--plugin", plugin, *args), config.cli_iterations)
+        ))
+    return results
+
+
+def bench_imports(config):
+    results = []
+    code = (
+        "import importlib, sys, time\n"
+        "start = time.perf_counter()\n"
+        "importlib.import_module(sys.argv[1])\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    for module in ["utils", *[f"plugins.{x}" for x in q_plugins._traverse_plugin_tree()]]:
+        timings = []
+        for _ in range(config.import_iterations):
+            process = subprocess.run(
+                [sys.executable, "-c", code, module], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+            if process.returncode:
+                break
+            timings.append(float(process.stdout))
+        if timings:
+            results.append(summarize(f"imports/{module}", timings))
+        else:
+            results.append({"name": f"imports/{module}", "skipped": process.stderr.decode().strip().splitlines()[-1]})
+    return results
+
+
+def _synthetic_tree(directory, plugins):
+    with open(os.path.join(ROOT, "plugins", "example", "example.py")) as fh:
+        source = fh.read()
+    root = os.path.join(directory, "plugins")
+    for index in range(plugins):
+        package = os.path.join(root, f"group{index // 10}")
+        os.makedirs(package, exist_ok=True)
+        with open(os.path.join(package, f"plugin{index}.py"), "w") as fh:
+            fh.write(source)
+    return root
+
+
+def bench_traverse(config):
+    results = []
+    for size in (10, 100, 1000):
+        with tempfile.TemporaryDirectory() as directory:
+            root = _synthetic_tree(directory, size)
+            cache_path = os.path.join(directory, "manifest.json")
+
+            def cold():
+                if os.path.exists(cache_path):
+                    os.unlink(cache_path)
+                assert len(q_plugins._traverse_plugin_tree(root, cache_path)) == size
+
+            results.append(summarize(f"traverse/{size}/cold", measure(cold, config.iterations // 5 or 1)))
+            results.append(summarize(
+                f"traverse/{size}/cached",
+                measure(lambda: q_plugins._traverse_plugin_tree(root, cache_path), config.iterations)
+            ))
+    return results
+
+
+def _check_scenarios(directory):
+    scenarios = []
+    certificate = standins.generate_certificate(directory)
+    smtp = standins.start(standins.SMTPStandIn(certificate=certificate))
+    common = ["-H", "localhost", "-p", str(smtp.port)]
+    scenarios.append(("example", "example.example", ["--hostaddress", "localhost"]))
+    scenarios.append(("smtp/connect", "protocols.smtp", ["--mode", "connect", *common]))
+    scenarios.append(("smtp/login", "protocols.smtp", [
+        "--mode", "login", *common, "--smtp-user", "user", "--smtp-password", "password"
+    ]))
+    if certificate:
+        smtps = standins.start(standins.SMTPStandIn(certificate=certificate, implicit_tls=True))
+        scenarios.append(("smtp/connect-starttls", "protocols.smtp", ["--mode", "connect", *common, "--start-tls"]))
+        scenarios.append(("smtp/connect-ssl", "protocols.smtp", [
+            "--mode", "connect", "-H", "localhost", "-p", str(smtps.port), "--ssl"
+        ]))
+        scenarios.append(("smtp/full-starttls", "protocols.smtp", [
+            "--mode", "full", *common, "--start-tls", "--smtp-user", "user", "--smtp-password", "password"
+        ]))
+    scenarios.append(("nagios", "wrapper.nagios", ["--command", standins.write_nagios_plugin(directory)]))
+    telegram = standins.start(standins.TelegramStandIn())
+    scenarios.append(("telegram", "notifications.telegram", [
+        "--api-url", telegram.url, "--bot-token", "token", "--user-id", "1", "--message", "benchmark"
+    ]))
+    scenarios.append(("icmp", "protocols.icmp", ["-H", "127.0.0.1", "--count", "1", "--interval", "0"]))
+    return scenarios
+
+
+def bench_checks(config):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name, plugin, args in _check_scenarios(directory):
+            module = importlib.import_module(f"plugins.{plugin}")
+            result = utils.invoke_plugin(module, args)
+            if result.state == utils.OutputState.UNKNOWN:
+                results.append({"name": f"checks/{name}", "skipped": result.output.strip().splitlines()[-1]})
+                continue
+            results.append(summarize(
+                f"checks/{name}/inprocess",
+                measure(lambda: utils.invoke_plugin(module, args), config.iterations),
+                state=result.state.value
+            ))
+            results.append(summarize(
+                f"checks/{name}/cli",
+                measure(lambda: run_launcher("--plugin", plugin, *args), config.cli_iterations),
+                state=result.state.value
+            ))
+    return results
+
+
+def bench_batch(config):
+    spec = json.dumps({"plugin": "example.example", "args": ["--hostaddress", "localhost"]})
+    stdin = "\n".join([spec] * config.batch_size).encode()
+    timings = measure(lambda: run_launcher("--batch", "-", stdin=stdin), 3, warmup=0)
+    result = summarize(f"batch/example/{config.batch_size}", timings)
+    # Throughput is reported in checks instead of batches per second
+    result["throughput"] = config.batch_size / result["p50"]
+    return [result]
+
+
+def compare(old_path, new_path):
+    with open(old_path) as fh:
+        old = {x["name"]: x for x in json.load(fh)["results"]}
+    with open(new_path) as fh:
+        new = {x["name"]: x for x in json.load(fh)["results"]}
+    print(f"{'benchmark':45} {'old p50':>10} {'new p50':>10} {'change':>8}")
+    for name, result in new.items():
+        if name not in old or "p50" not in result or "p50" not in old[name]:
+            continue
+        change = (result["p50"] - old[name]["p50"]) / old[name]["p50"] * 100
+        print(f"{name:45} {old[name]['p50'] * 1000:9.2f}ms {result['p50'] * 1000:9.2f}ms {change:+7.1f}%")
+
+
+def _git_revision():
+    if not shutil.which("git"):
+        return None
+    process = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return process.stdout.decode().strip() or None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default="bench_results.json", help="Result file. (default: %(default)s)")
+    parser.add_argument("--only", nargs="+", choices=GROUPS, default=GROUPS, help="Benchmark groups to run")
+    parser.add_argument("--iterations", type=int, default=50, help="Iterations in process. (default: %(default)s)")
+    parser.add_argument(
+        "--cli-iterations", type=int, default=10, help="Iterations of launcher processes. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--import-iterations", type=int, default=5, help="Iterations of the import benchmarks. (default: %(default)s)"
+    )
+    parser.add_argument("--batch-size", type=int, default=50, help="Checks of the batch benchmark. (default: %(default)s)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files")
+    config = parser.parse_args()
+    if config.compare:
+        compare(*config.compare)
+        return
+
+    results = []
+    for group in config.only:
+        print(f"Running {group} benchmarks", file=sys.stderr)
+        results.extend(globals()[f"bench_{group}"](config))
+    with open(config.output, "w") as fh:
+        json.dump({
+            "meta": {
+                "timestamp": time.time(),
+                "revision": _git_revision(),
+                "python": sys.version,
+                "platform": platform.platform(),
+            },
+            "results": results,
+        }, fh, indent=2)
+    for result in results:
+        if "skipped" in result:
+            print(f"{result['name']:45} skipped: {result['skipped']}")
+        else:
+            print(f"{result['name']:45} p50 {result['p50'] * 1000:9.2f}ms  p95 {result['p95'] * 1000:9.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""Local stand-ins for the services the shipped plugins talk to"""
+import base64
+import http.server
+import json
+import os
+import shutil
+import socket
+import socketserver
+import ssl
+import stat
+import subprocess
+import threading
+
+
+def generate_certificate(directory):
+    """This method is used to create a self signed certificate for localhost
+
+    cryptography is used if it is installed, openssl otherwise.
+
+    :param directory: Directory to write cert.pem and key.pem to
+    :return: Tuple of certificate and key path or None if neither is available
+    """
+    cert_path = os.path.join(directory, "cert.pem")
+    key_path = os.path.join(directory, "key.pem")
+    try:
+        import datetime
+
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+        from cryptography.x509.oid import NameOID
+    except ImportError:
+        if not shutil.which("openssl"):
+            return None
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key_path, "-out", cert_path,
+             "-days", "30", "-subj", "/CN=localhost"],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        return cert_path, key_path
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()).not_valid_before(now) \
+        .not_valid_after(now + datetime.timedelta(days=30)).sign(key, hashes.SHA256())
+    with open(cert_path, "wb") as fh:
+        fh.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as fh:
+        fh.write(key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        ))
+    return cert_path, key_path
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def _reply(self, *lines):
+        # A single write per reply, otherwise multiline replies suffer from delayed ACKs
+        text = "".join(
+            f"{line[:3]}{'-' if index < len(lines) - 1 else ' '}{line[4:]}\r\n" for index, line in enumerate(lines)
+        )
+        self.wfile.write(text.encode("ascii"))
+        self.wfile.flush()
+
+    def _wrap_tls(self):
+        self.request = self.server.tls_context.wrap_socket(self.request, server_side=True)
+        self.rfile = self.request.makefile("rb")
+        self.wfile = self.request.makefile("wb")
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        tls = False
+        if self.server.implicit_tls:
+            self._wrap_tls()
+            tls = True
+        self._reply("220 localhost ESMTP stand-in")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", errors="replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                extensions = ["250 localhost", "250 AUTH PLAIN LOGIN", "250 8BITMIME"]
+                if self.server.tls_context and not tls:
+                    extensions.append("250 STARTTLS")
+                self._reply(*extensions)
+            elif verb == "HELO":
+                self._reply("250 localhost")
+            elif verb == "STARTTLS" and self.server.tls_context and not tls:
+                self._reply("220 2.0.0 Ready to start TLS")
+                self._wrap_tls()
+                tls = True
+            elif verb == "AUTH":
+                self._auth(command)
+            elif verb == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                self._reply("250 2.0.0 Ok: queued")
+            elif verb == "NOOP":
+                self._reply("250 2.0.0 Ok")
+            elif verb == "QUIT":
+                self._reply("221 2.0.0 Bye")
+                return
+            else:
+                self._reply("250 2.0.0 Ok")
+
+    def _auth(self, command):
+        parts = command.split()
+        mechanism = parts[1].upper() if len(parts) > 1 else ""
+        if mechanism == "PLAIN":
+            if len(parts) > 2:
+                response = parts[2]
+            else:
+                self._reply("334 ")
+                response = self.rfile.readline().strip()
+            credentials = base64.b64decode(response).split(b"\0")
+            user, password = credentials[1], credentials[2]
+        elif mechanism == "LOGIN":
+            self._reply("334 VXNlcm5hbWU6")
+            user = base64.b64decode(self.rfile.readline().strip())
+            self._reply("334 UGFzc3dvcmQ6")
+            password = base64.b64decode(self.rfile.readline().strip())
+        else:
+            self._reply("504 5.5.4 Unrecognized authentication type")
+            return
+        if (user.decode(), password.decode()) == self.server.credentials:
+            self._reply("235 2.7.0 Authentication successful")
+        else:
+            self._reply("535 5.7.8 Authentication failed")
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """SMTP server supporting EHLO, STARTTLS or implicit TLS, AUTH PLAIN/LOGIN, DATA and NOOP"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, certificate=None, implicit_tls=False, credentials=("user", "password")):
+        super().__init__(("127.0.0.1", 0), _SMTPHandler)
+        self.tls_context = None
+        if certificate:
+            self.tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.tls_context.load_cert_chain(*certificate)
+        self.implicit_tls = implicit_tls
+        self.credentials = credentials
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class _TelegramHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = json.dumps({"ok": True, "result": {"message_id": 1}}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TelegramStandIn(http.server.ThreadingHTTPServer):
+    """HTTP server answering every request like a successful sendMessage of the bot API"""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _TelegramHandler)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+def start(server):
+    """This method is used to serve a stand-in in a background thread
+
+    :param server: Stand-in to serve
+    :return: The server
+    """
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_nagios_plugin(directory, metrics=20):
+    """This method is used to create a fake nagios plugin printing long text and performance data
+
+    :param directory: Directory to create the plugin in
+    :param metrics: Number of performance data metrics
+    :return: Path of the plugin
+    """
+    perfdata = " ".join(f"'metric {i}'={i}.5ms;100;200;0;1000" for i in range(metrics))
+    path = os.path.join(directory, "check_fake")
+    with open(path, "w") as fh:
+        # A quoted heredoc keeps the single quotes around the labels
+        fh.write(f"#!/bin/sh\ncat <<'EOF'\nFAKE OK - all fine | {perfdata}\nlong text\nEOF\nexit 0\n")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
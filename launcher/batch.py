@@ -0,0 +1,72 @@
+import concurrent.futures
+import json
+import sys
+
+from launcher import runner
+
+
+def _parse_spec(line, line_number, default_timeout):
+    spec = json.loads(line)
+    if not isinstance(spec, dict):
+        raise ValueError("Check spec has to be an object")
+    plugin = spec.get("plugin")
+    args = spec.get("args", [])
+    if not isinstance(plugin, str) or not isinstance(args, list):
+        raise ValueError("Check spec requires plugin as string and args as list")
+    return {
+        "id": spec.get("id", line_number),
+        "plugin": plugin,
+        "args": [str(x) for x in args],
+        "timeout": float(spec.get("timeout", default_timeout)),
+    }
+
+
+def _run_spec(spec):
+    result = runner.run_check(spec["plugin"], spec["args"], spec["timeout"])
+    return {"id": spec["id"], "plugin": spec["plugin"], **result}
+
+
+def _write(out, result):
+    out.write(json.dumps(result) + "\n")
+    out.flush()
+
+
+def run_batch(stream, workers, default_timeout, out=sys.stdout):
+    """This method is used to execute the checks of a JSONL stream concurrently
+
+    Every line is a check spec of the form
+    {"id": "web1-ping", "plugin": "protocols.icmp", "args": ["-H", "web1"], "timeout": 10}.
+    id defaults to the line number and timeout to default_timeout.
+    One result is written per line in the order the checks complete.
+
+    :param stream: Iterable of lines
+    :param workers: Maximum number of checks executed at the same time
+    :param default_timeout: Timeout in seconds for specs without timeout
+    :param out: Stream to write the results to
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for line_number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                spec = _parse_spec(line, line_number, default_timeout)
+            except (ValueError, TypeError) as err:
+                _write(out, {
+                    "id": line_number, "plugin": None, "state": "unknown", "output": f"Invalid check spec: {err}",
+                    "datasets": [], "exit_code": 3, "duration": 0
+                })
+                continue
+            # Results are written as soon as they are done, even while the input is still being read.
+            # Only read ahead a bit, so arbitrary large batches don't end up in memory
+            done, pending = concurrent.futures.wait(
+                pending,
+                timeout=None if len(pending) >= workers * 2 else 0,
+                return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                _write(out, future.result())
+            pending.add(pool.submit(_run_spec, spec))
+        for future in concurrent.futures.as_completed(pending):
+            _write(out, future.result())
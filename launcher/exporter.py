@@ -0,0 +1,175 @@
+import http.server
+import math
+import signal
+import socket
+import sys
+import threading
+import time
+
+from launcher import scheduler
+
+_EXIT_CODES = {"ok": 0, "warn": 1, "critical": 2, "unknown": 3}
+
+# Metric families in the order they are exposed, every family is rendered as one contiguous block
+_FAMILIES = {
+    "q_plugins_check_state": "State of the check, 0 ok, 1 warn, 2 critical, 3 unknown",
+    "q_plugins_check_duration_seconds": "Duration of the last run of the check",
+    "q_plugins_check_last_run_timestamp_seconds": "Unix time the last run of the check completed",
+    "q_plugins_dataset": "Value of a dataset of the check",
+    "q_plugins_dataset_warning": "Warning threshold of a dataset of the check",
+    "q_plugins_dataset_critical": "Critical threshold of a dataset of the check",
+    "q_plugins_dataset_min": "Minimum possible value of a dataset of the check",
+    "q_plugins_dataset_max": "Maximum possible value of a dataset of the check",
+    "q_plugins_scheduler_queue_depth": "Checks which are due but wait for a worker or their group",
+    "q_plugins_scheduler_lag_seconds": "Maximum delay between the due time and the start of a check since the last stats",
+}
+
+_DATASET_FAMILIES = {
+    "value": "q_plugins_dataset",
+    "warning": "q_plugins_dataset_warning",
+    "critical": "q_plugins_dataset_critical",
+    "min": "q_plugins_dataset_min",
+    "max": "q_plugins_dataset_max",
+}
+
+OPENMETRICS_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+TEXT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return None
+    # Thresholds of wrapped nagios plugins are strings, only plain numbers are exported, not ranges
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            return None
+    if not isinstance(value, (int, float)) or math.isnan(value):
+        return None
+    return repr(float(value))
+
+
+def render_check(result, finished):
+    """Renders the samples of a check grouped by metric family
+
+    :param result: Result record of the scheduler
+    :param finished: Unix time the run completed
+    :return: dict of metric family to list of sample lines
+    """
+    labels = f'check="{_label_value(result["id"])}",plugin="{_label_value(result["plugin"])}"'
+    samples = {
+        "q_plugins_check_state": [f"q_plugins_check_state{{{labels}}} {_EXIT_CODES.get(result['state'], 3)}"],
+        "q_plugins_check_duration_seconds": [
+            f"q_plugins_check_duration_seconds{{{labels}}} {result['duration']}"
+        ],
+        "q_plugins_check_last_run_timestamp_seconds": [
+            f"q_plugins_check_last_run_timestamp_seconds{{{labels}}} {finished:.3f}"
+        ],
+    }
+    for dataset in result["datasets"]:
+        if not isinstance(dataset, dict) or "name" not in dataset:
+            continue
+        dataset_labels = f'{labels},dataset="{_label_value(dataset["name"])}"'
+        if dataset.get("unit"):
+            dataset_labels += f',unit="{_label_value(dataset["unit"])}"'
+        for key, family in _DATASET_FAMILIES.items():
+            # Ranges like 10:20 can't be exposed as a number and are skipped
+            value = _number(dataset.get(key))
+            if value is not None:
+                samples.setdefault(family, []).append(f"{family}{{{dataset_labels}}} {value}")
+    return samples
+
+
+class Exporter:
+    """Keeps the rendered metrics of the latest results of the checks run by the scheduler
+
+    The body is rendered once per completed run, scrapes only read it.
+    """
+
+    def __init__(self, checks):
+        self.checks = checks
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._scheduler_samples = {}
+        self.body = self._assemble()
+
+    def _assemble(self):
+        lines = []
+        for family, description in _FAMILIES.items():
+            lines.append(f"# TYPE {family} gauge")
+            lines.append(f"# HELP {family} {description}")
+            for check in self.checks:
+                lines.extend(self._samples.get(check["name"], {}).get(family, []))
+            lines.extend(self._scheduler_samples.get(family, []))
+        lines.append("# EOF\n")
+        return "\n".join(lines).encode("utf-8")
+
+    def record(self, record):
+        """Sink of the scheduler"""
+        samples = render_check(record, time.time()) if record["type"] == "result" else {
+            "q_plugins_scheduler_queue_depth": [f"q_plugins_scheduler_queue_depth {record['queue_depth']}"],
+            "q_plugins_scheduler_lag_seconds": [f"q_plugins_scheduler_lag_seconds {record['lag_max']}"],
+        }
+        with self._lock:
+            if record["type"] == "result":
+                self._samples[record["id"]] = samples
+            else:
+                self._scheduler_samples = samples
+            self.body = self._assemble()
+
+
+class _MetricsServer(http.server.ThreadingHTTPServer):
+    def __init__(self, listen, exporter):
+        self.address_family = socket.AF_INET6 if ":" in listen[0] else socket.AF_INET
+        self.exporter = exporter
+        super().__init__(listen, _MetricsHandler)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.exporter.body
+        openmetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+        self.send_response(200)
+        self.send_header("Content-Type", OPENMETRICS_TYPE if openmetrics else TEXT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_listen(value):
+    """Splits host:port, IPv6 addresses have to be enclosed in brackets"""
+    host, _, port = value.rpartition(":")
+    return host.strip("[]") or "127.0.0.1", int(port)
+
+
+def serve(checks, listen, workers, limits=None):
+    """This method is used to export the results of checks over http until terminated
+
+    :param checks: Checks as returned by scheduler.load_config
+    :param listen: Tuple of host and port to listen on
+    :param workers: Maximum number of checks executed at the same time
+    :param limits: Concurrency limits of groups as returned by scheduler.load_config
+    """
+    exporter = Exporter(checks)
+    server = _MetricsServer(listen, exporter)
+    check_scheduler = scheduler.Scheduler(checks, workers, exporter.record, limits, stats_interval=15)
+    threading.Thread(target=check_scheduler.run, daemon=True).start()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        check_scheduler.stop()
+        server.server_close()
@@ -0,0 +1,113 @@
+import ast
+import contextlib
+import hashlib
+import json
+import os
+
+_CACHE_VERSION = 1
+_METADATA = ("__help__", "__requirements__")
+
+
+def _parse_plugin(source, path):
+    """This method is used to read the metadata of a plugin without executing it
+
+    :param source: Source code of the plugin
+    :param path: Path of the plugin, only used for error messages
+    :return: dict with help and requirements or None if the file is no valid plugin
+    """
+    try:
+        tree = ast.parse(source, path)
+    except (SyntaxError, ValueError):
+        return None
+    metadata = {}
+    has_execute = False
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            has_execute = has_execute or node.name == "execute"
+            continue
+        if isinstance(node, ast.Assign):
+            targets = [x.id for x in node.targets if isinstance(x, ast.Name)]
+        elif isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name) and node.value is not None:
+            targets = [node.target.id]
+        else:
+            continue
+        has_execute = has_execute or "execute" in targets
+        for target in targets:
+            if target in _METADATA:
+                try:
+                    metadata[target] = ast.literal_eval(node.value)
+                except ValueError:
+                    continue
+    plugin_help = metadata.get("__help__")
+    requirements = metadata.get("__requirements__")
+    if not has_execute or not isinstance(plugin_help, str) or not isinstance(requirements, (list, tuple)):
+        return None
+    return {"help": plugin_help, "requirements": [str(x) for x in requirements]}
+
+
+def _load_cache(cache_path):
+    try:
+        with open(cache_path) as fh:
+            cache = json.load(fh)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get("version") != _CACHE_VERSION:
+        return {}
+    return cache.get("files", {})
+
+
+def _write_cache(cache_path, files):
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w") as fh:
+            json.dump({"version": _CACHE_VERSION, "files": files}, fh)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # A read only installation still works, it only has to parse the plugins every time
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_path)
+
+
+def load_manifest(plugin_root, cache_path):
+    """This method is used to retrieve the metadata of all plugins below plugin_root
+
+    Only files whose mtime or size changed since the last call are read again.
+    Files are only parsed if their content hash changed as well.
+
+    :param plugin_root: Directory of the plugins package
+    :param cache_path: Path of the manifest cache file
+    :return: dict of import path to dict with help and requirements
+    """
+    cached_files = _load_cache(cache_path)
+    files = {}
+    plugin_list = {}
+    changed = False
+    for dir_path, dir_names, file_names in os.walk(plugin_root):
+        dir_names.sort()
+        for file in sorted(file_names):
+            if file == "__init__.py" or not file.endswith(".py"):
+                continue
+            path = os.path.join(dir_path, file)
+            import_path = os.path.relpath(path[:-3], plugin_root).replace(os.sep, ".")
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entry = cached_files.get(import_path)
+            if entry is None or entry["mtime"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+                try:
+                    with open(path, "rb") as fh:
+                        source = fh.read()
+                except OSError:
+                    continue
+                digest = hashlib.sha256(source).hexdigest()
+                if entry is None or entry["hash"] != digest:
+                    entry = {"hash": digest, "plugin": _parse_plugin(source, path)}
+                entry = dict(entry, mtime=stat.st_mtime_ns, size=stat.st_size)
+                changed = True
+            files[import_path] = entry
+            if entry["plugin"] is not None:
+                plugin_list[import_path] = entry["plugin"]
+    if changed or files.keys() != cached_files.keys():
+        _write_cache(cache_path, files)
+    return plugin_list
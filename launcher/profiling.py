@@ -0,0 +1,84 @@
+import contextlib
+import os
+import resource
+import sys
+import tempfile
+import time
+
+
+def default_output(plugin):
+    """Returns the path prefix of the stats files if --profile-output is not given"""
+    return os.path.join(tempfile.gettempdir(), f"q_plugins-{plugin}-{os.getpid()}")
+
+
+@contextlib.contextmanager
+def profile(kind, output):
+    """Profiles the enclosed block and writes the stats when it is left
+
+    :param kind: cprofile, tracemalloc or all
+    :param output: Path prefix of the stats files. cProfile stats are written to OUTPUT.prof and can be
+    read with pstats, tracemalloc snapshots to OUTPUT.tracemalloc and can be read with tracemalloc.Snapshot.load
+    """
+    import tracemalloc
+
+    profiler = None
+    tracing = kind in ("tracemalloc", "all") and not tracemalloc.is_tracing()
+    if tracing:
+        # Enough frames to see which plugin code triggered an allocation deep in a library
+        tracemalloc.start(25)
+    if kind in ("cprofile", "all"):
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(f"{output}.prof")
+            print(f"cProfile stats written to {output}.prof", file=sys.stderr)
+        if tracing:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            snapshot.dump(f"{output}.tracemalloc")
+            print(f"tracemalloc snapshot written to {output}.tracemalloc", file=sys.stderr)
+
+
+class ResourceUsage:
+    """Measures the resources used by the enclosed block, see --resource-usage
+
+    Allocations are traced with a single frame, which keeps the overhead of tracemalloc low.
+    """
+
+    def __enter__(self):
+        import tracemalloc
+
+        self._tracing = not tracemalloc.is_tracing()
+        if self._tracing:
+            tracemalloc.start(1)
+        tracemalloc.reset_peak()
+        self._rusage = resource.getrusage(resource.RUSAGE_SELF)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        import tracemalloc
+
+        self.elapsed = time.perf_counter() - self._start
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        self.user = rusage.ru_utime - self._rusage.ru_utime
+        self.system = rusage.ru_stime - self._rusage.ru_stime
+        # ru_maxrss is the high-water mark of the whole process in kilobytes on linux
+        self.max_rss = rusage.ru_maxrss
+        self.peak_allocated = tracemalloc.get_traced_memory()[1]
+        if self._tracing:
+            tracemalloc.stop()
+
+    def datasets(self, utils):
+        return [
+            utils.build_dataset(name="Plugin wall time", value=round(self.elapsed, 4), unit="s"),
+            utils.build_dataset(name="Plugin CPU user time", value=round(self.user, 4), unit="s"),
+            utils.build_dataset(name="Plugin CPU system time", value=round(self.system, 4), unit="s"),
+            utils.build_dataset(name="Plugin max RSS", value=self.max_rss, unit="KB"),
+            utils.build_dataset(name="Plugin peak allocations", value=self.peak_allocated, unit="B"),
+        ]
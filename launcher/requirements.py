@@ -0,0 +1,129 @@
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+CONSTRAINTS = "constraints.txt"
+
+
+def normalize(name):
+    """Normalizes a project name as pip does, e.g. icmp_lib and ICMP.lib are both icmp-lib"""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def read_constraints(wheelhouse):
+    """This method is used to read the versions pinned by build_wheelhouse
+
+    :param wheelhouse: Directory of the wheelhouse
+    :return: dict of normalized project name to version
+    """
+    pins = {}
+    try:
+        with open(os.path.join(wheelhouse, CONSTRAINTS)) as fh:
+            for line in fh:
+                name, _, version = line.split("#")[0].strip().partition("==")
+                if version:
+                    pins[normalize(name)] = version
+    except FileNotFoundError:
+        pass
+    return pins
+
+
+def is_satisfied(requirement, pins=None):
+    """This method is used to check whether a requirement is installed already
+
+    Version specifiers and markers are only evaluated if packaging is installed, otherwise
+    only plain project names can be satisfied. Dependencies of the requirement are not checked.
+
+    :param requirement: Requirement as listed in __requirements__
+    :param pins: dict of normalized project name to the version that has to be installed
+    :return: True if the requirement doesn't have to be installed
+    """
+    from importlib import metadata
+
+    specifier = None
+    try:
+        from packaging.requirements import InvalidRequirement, Requirement
+    except ImportError:
+        match = re.fullmatch(r"\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*", requirement)
+        if not match:
+            return False
+        name = match.group(1)
+    else:
+        try:
+            parsed = Requirement(requirement)
+        except InvalidRequirement:
+            return False
+        if parsed.marker and not parsed.marker.evaluate():
+            # The requirement doesn't apply to this environment
+            return True
+        if parsed.url or parsed.extras:
+            return False
+        name, specifier = parsed.name, parsed.specifier
+    try:
+        installed = metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return False
+    pinned = (pins or {}).get(normalize(name))
+    if pinned is not None and installed != pinned:
+        return False
+    return specifier is None or specifier.contains(installed, prereleases=True)
+
+
+def build_wheelhouse(requirements, wheelhouse):
+    """This method is used to build wheels of requirements and their dependencies for offline installation
+
+    All requirements are resolved by a single pip run, so the wheelhouse holds one consistent set of versions.
+    The versions are pinned in constraints.txt of the wheelhouse, install uses them.
+    Wheels already in the wheelhouse are reused instead of being downloaded again.
+
+    :param requirements: List of requirements
+    :param wheelhouse: Directory of the wheelhouse, created if it doesn't exist
+    :return: Exit code of pip
+    """
+    os.makedirs(wheelhouse, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=wheelhouse) as build:
+        process = subprocess.run([
+            sys.executable, "-m", "pip", "wheel", "--wheel-dir", build, "--find-links", wheelhouse, *requirements
+        ])
+        if process.returncode:
+            return process.returncode
+        pins = {}
+        for filename in sorted(os.listdir(build)):
+            if not filename.endswith(".whl"):
+                continue
+            # Wheel file names are NAME-VERSION(-BUILD)?-PYTHON-ABI-PLATFORM.whl
+            name, version = filename.split("-")[:2]
+            pins[normalize(name)] = version
+            os.replace(os.path.join(build, filename), os.path.join(wheelhouse, filename))
+    with open(os.path.join(wheelhouse, CONSTRAINTS), "w") as fh:
+        fh.write("".join(f"{name}=={version}\n" for name, version in sorted(pins.items())))
+    print(f"Built {len(pins)} wheels in {wheelhouse}")
+    return 0
+
+
+def install(requirements, wheelhouse=None, user=False):
+    """This method is used to install the requirements which are not satisfied yet
+
+    :param requirements: List of requirements
+    :param wheelhouse: Directory built with build_wheelhouse to install from without network access.
+    Without a wheelhouse requirements are installed or upgraded from the package index
+    :param user: Install with --user
+    :return: Exit code of pip
+    """
+    pins = read_constraints(wheelhouse) if wheelhouse else {}
+    missing = [x for x in requirements if not is_satisfied(x, pins)]
+    if not missing:
+        print("All requirements are satisfied")
+        return 0
+    command = [sys.executable, "-m", "pip", "install"]
+    if wheelhouse:
+        command.extend(["--no-index", "--find-links", wheelhouse])
+        if pins:
+            command.extend(["--constraint", os.path.join(wheelhouse, CONSTRAINTS)])
+    else:
+        command.append("-U")
+    if user:
+        command.append("--user")
+    return subprocess.run([*command, *missing]).returncode
@@ -0,0 +1,73 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+LAUNCHER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "q_plugins.py")
+
+
+def _kill_group(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        process.kill()
+
+
+def _parse_output(stdout, stderr):
+    try:
+        result = json.loads(stdout)
+        if isinstance(result, dict) and "state" in result:
+            return {
+                "state": result["state"],
+                "output": result.get("output", ""),
+                "datasets": result.get("datasets", []),
+            }
+    except ValueError:
+        pass
+    # The plugin failed before it could build an output, e.g. because of invalid arguments
+    return {
+        "state": "unknown",
+        "output": (stdout + stderr).strip(),
+        "datasets": [],
+    }
+
+
+def run_check(plugin, args, timeout):
+    """This method is used to execute a check in a separate launcher process
+
+    The process and all its children are killed once the timeout is exceeded.
+
+    :param plugin: Import path of the plugin below plugins
+    :param args: Arguments for the plugin
+    :param timeout: Timeout in seconds
+    :return: dict with state, output, datasets, exit_code and duration
+    """
+    start = time.monotonic()
+    process = subprocess.Popen(
+        # The output is parsed below, so json is forced regardless of $Q_PLUGINS_OUTPUT_FORMAT
+        [sys.executable, LAUNCHER, "--plugin", plugin, *args, "--output-format", "json"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True,
+    )
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill_group(process)
+        process.communicate()
+        return {
+            "state": "unknown",
+            "output": f"Check timed out after {timeout} seconds",
+            "datasets": [],
+            "exit_code": 3,
+            "duration": round(time.monotonic() - start, 3),
+        }
+    result = _parse_output(
+        stdout.decode("utf-8", errors="replace"), stderr.decode("utf-8", errors="replace")
+    )
+    result["exit_code"] = process.returncode
+    result["duration"] = round(time.monotonic() - start, 3)
+    return result
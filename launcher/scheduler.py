@@ -0,0 +1,227 @@
+import concurrent.futures
+import heapq
+import importlib
+import json
+import sys
+import threading
+import time
+import zlib
+
+from launcher import runner
+
+
+def load_config(path):
+    """This method is used to read the checks of the scheduler and the exporter
+
+    The file is either a json list of checks or an object with the list as checks and
+    the concurrency limits of groups as limits, e.g.
+    {"checks": [{"name": "mx1-connect", "plugin": "protocols.smtp", "args": ["-H", "mx1"], "interval": 60,
+    "timeout": 10, "group": "smtp:mx1"}], "limits": {"smtp:mx1": 2}}.
+    name defaults to the plugin, interval to 60 seconds and timeout to 30 seconds, but at most the interval.
+    Checks without group are only limited by the number of workers.
+
+    :param path: Path of the config file
+    :return: Tuple of the list of checks and the dict of limits
+    :raises ValueError: If the config is invalid
+    """
+    with open(path) as fh:
+        config = json.load(fh)
+    limits = {}
+    if isinstance(config, dict):
+        limits = config.get("limits", {})
+        config = config.get("checks")
+    if not isinstance(config, list):
+        raise ValueError("Config has to be a list of checks")
+    if not isinstance(limits, dict) or not all(isinstance(x, int) and x > 0 for x in limits.values()):
+        raise ValueError("Limits have to map groups to positive integers")
+    checks = []
+    names = set()
+    for spec in config:
+        if not isinstance(spec, dict) or not isinstance(spec.get("plugin"), str) \
+                or not isinstance(spec.get("args", []), list):
+            raise ValueError(f"Check requires plugin as string and args as list: {spec}")
+        name = str(spec.get("name", spec["plugin"]))
+        if name in names:
+            raise ValueError(f"Check name {name} is not unique")
+        names.add(name)
+        interval = float(spec.get("interval", 60))
+        if interval <= 0:
+            raise ValueError(f"Interval of check {name} has to be positive")
+        checks.append({
+            "name": name,
+            "plugin": spec["plugin"],
+            "args": [str(x) for x in spec.get("args", [])],
+            "interval": interval,
+            "timeout": min(float(spec.get("timeout", 30)), interval),
+            "group": spec.get("group"),
+        })
+    return checks, limits
+
+
+def open_sink(spec):
+    """This method is used to build the callable records of the scheduler are passed to
+
+    :param spec: stdout, file:PATH to append json lines to a file or module:callable to call a function
+    :return: Callable receiving a record, calls are serialized
+    :raises ValueError: If the spec is invalid
+    """
+    kind, _, target = spec.partition(":")
+    if kind == "stdout" and not target:
+        fh = sys.stdout
+    elif kind == "file" and target:
+        fh = open(target, "a", buffering=1)
+    elif kind == "module" and target:
+        module, _, name = target.rpartition(":")
+        try:
+            func = getattr(importlib.import_module(module), name)
+        except (ImportError, AttributeError, ValueError) as err:
+            raise ValueError(f"Sink {target} can't be imported: {err}")
+        lock = threading.Lock()
+
+        def call(record):
+            with lock:
+                func(record)
+        return call
+    else:
+        raise ValueError(f"Unknown sink {spec}, use stdout, file:PATH or module:callable")
+    lock = threading.Lock()
+
+    def write(record):
+        line = json.dumps(record) + "\n"
+        with lock:
+            fh.write(line)
+            fh.flush()
+    return write
+
+
+def _percentile(ordered, percentile):
+    return ordered[min(int(len(ordered) * percentile), len(ordered) - 1)] if ordered else 0
+
+
+class Scheduler:
+    """Runs checks on their intervals with a bounded number of workers
+
+    The first run of every check is delayed by a jitter derived from its name, so checks with the
+    same interval are spread over it instead of starting at once, and keep their offset across restarts.
+    A check never overlaps with itself, runs it missed while still running are skipped.
+    Checks of a group with a limit don't run more often at the same time than the limit allows.
+    """
+
+    def __init__(self, checks, workers, sink, limits=None, stats_interval=60):
+        """
+        :param checks: Checks as returned by load_config
+        :param workers: Maximum number of checks executed at the same time
+        :param sink: Callable receiving a result record after every run and a stats record every stats_interval
+        :param limits: dict of group to the maximum number of its checks executed at the same time
+        :param stats_interval: Seconds between two stats records
+        """
+        self.checks = checks
+        self.workers = workers
+        self.sink = sink
+        self.limits = limits or {}
+        self.stats_interval = stats_interval
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._condition = threading.Condition()
+        start = time.monotonic()
+        self._queue = [
+            (start + zlib.crc32(check["name"].encode("utf-8")) / 2 ** 32 * check["interval"], index)
+            for index, check in enumerate(checks)
+        ]
+        heapq.heapify(self._queue)
+        # Checks which are due, but wait for a free worker or for their group
+        self._ready = []
+        self._running = 0
+        self._groups = {}
+        self._lags = []
+        self._completed = 0
+        self._skipped = 0
+        self._max_depth = 0
+        self._stopped = False
+
+    def _dispatch(self, now):
+        while self._queue and self._queue[0][0] <= now:
+            self._ready.append(heapq.heappop(self._queue))
+        self._max_depth = max(self._max_depth, len(self._ready))
+        remaining = []
+        for due, index in self._ready:
+            group = self.checks[index]["group"]
+            if self._running >= self.workers or \
+                    (group in self.limits and self._groups.get(group, 0) >= self.limits[group]):
+                remaining.append((due, index))
+                continue
+            self._running += 1
+            self._groups[group] = self._groups.get(group, 0) + 1
+            self._lags.append(now - due)
+            self._pool.submit(self._run, index, due, now - due)
+        self._ready = remaining
+
+    def _run(self, index, due, lag):
+        check = self.checks[index]
+        scheduled = time.time() - lag
+        try:
+            result = runner.run_check(check["plugin"], check["args"], check["timeout"])
+        except Exception as err:
+            # The check has to be rescheduled in any case, otherwise it would silently stop running
+            result = {"state": "unknown", "output": str(err), "datasets": [], "exit_code": 3, "duration": 0}
+        with self._condition:
+            self._running -= 1
+            self._groups[check["group"]] -= 1
+            self._completed += 1
+            due += check["interval"]
+            now = time.monotonic()
+            if due <= now:
+                missed = int((now - due) // check["interval"]) + 1
+                self._skipped += missed
+                due += missed * check["interval"]
+            heapq.heappush(self._queue, (due, index))
+            self._condition.notify()
+        self.sink({
+            "type": "result", "id": check["name"], "plugin": check["plugin"], **result,
+            "scheduled": round(scheduled, 3), "lag": round(lag, 3),
+        })
+
+    def _stats(self):
+        lags = sorted(self._lags)
+        record = {
+            "type": "stats",
+            "time": round(time.time(), 3),
+            "checks": len(self.checks),
+            "running": self._running,
+            "queue_depth": len(self._ready),
+            "max_queue_depth": self._max_depth,
+            "completed": self._completed,
+            "skipped": self._skipped,
+            "lag_p50": round(_percentile(lags, 0.5), 3),
+            "lag_p95": round(_percentile(lags, 0.95), 3),
+            "lag_max": round(lags[-1] if lags else 0, 3),
+        }
+        self._lags = []
+        self._completed = 0
+        self._skipped = 0
+        self._max_depth = len(self._ready)
+        return record
+
+    def run(self):
+        """Dispatches checks until stop is called"""
+        next_stats = time.monotonic() + self.stats_interval
+        while True:
+            stats = None
+            with self._condition:
+                if self._stopped:
+                    return
+                now = time.monotonic()
+                self._dispatch(now)
+                if now >= next_stats:
+                    stats = self._stats()
+                    next_stats = now + self.stats_interval
+                else:
+                    wakeup = min(self._queue[0][0] if self._queue else next_stats, next_stats)
+                    self._condition.wait(max(wakeup - now, 0))
+            if stats:
+                self.sink(stats)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,153 @@
+import base64
+import contextlib
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import time
+
+
+class CheckAborted(Exception):
+    """Raised by forward if the server doesn't return a result"""
+
+
+class _CheckServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    # Every request is handled in a child forked from the warm server process,
+    # so plugins may keep calling exit() and parsing sys.argv as they do on the command line.
+    def __init__(self, socket_path, run, timeout):
+        self.run = run
+        self.check_timeout = timeout
+        # pid of every running child to the time it was forked
+        self.started = {}
+        super().__init__(socket_path, _CheckHandler)
+
+    def process_request(self, request, client_address):
+        forked = set(self.active_children or ())
+        super().process_request(request, client_address)
+        # Only the server returns, the child exits after handling the request
+        for pid in set(self.active_children or ()) - forked:
+            self.started[pid] = time.monotonic()
+
+    def service_actions(self):
+        super().service_actions()
+        now = time.monotonic()
+        for pid, started in list(self.started.items()):
+            if pid in (self.active_children or ()) and now - started > self.check_timeout:
+                # The client only sees the connection closed without a result
+                try:
+                    os.killpg(pid, signal.SIGKILL)
+                except (ProcessLookupError, PermissionError):
+                    # The child didn't get to create its process group yet
+                    with contextlib.suppress(ProcessLookupError):
+                        os.kill(pid, signal.SIGKILL)
+                with contextlib.suppress(ChildProcessError):
+                    os.waitpid(pid, 0)
+                self.active_children.discard(pid)
+            if pid not in (self.active_children or ()):
+                del self.started[pid]
+
+
+class _CheckHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        # Own process group, so the processes a check started are killed with it
+        os.setpgid(0, 0)
+        super().setup()
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            argv = [str(x) for x in request["argv"]]
+        except (ValueError, KeyError, TypeError):
+            response = {"exit_code": 3, "stdout": "Invalid request\n", "stderr": ""}
+        else:
+            response = _run_check(self.server.run, argv)
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+def _exit_code(err):
+    if err.code is None:
+        return 0
+    if isinstance(err.code, int):
+        return err.code
+    print(err.code, file=sys.stderr)
+    return 1
+
+
+def _run_check(run, argv):
+    # stdout has a binary buffer, as results may be encoded in a binary format
+    stdout = io.TextIOWrapper(io.BytesIO(), encoding="utf-8", write_through=True)
+    stderr = io.StringIO()
+    sys.argv = [sys.argv[0], *argv]
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            run(argv)
+            exit_code = 0
+        except SystemExit as err:
+            exit_code = _exit_code(err)
+    stdout.flush()
+    response = {"exit_code": exit_code, "stderr": stderr.getvalue()}
+    output = stdout.buffer.getvalue()
+    try:
+        response["stdout"] = output.decode("utf-8")
+    except UnicodeDecodeError:
+        response["stdout_base64"] = base64.b64encode(output).decode("ascii")
+    return response
+
+
+def serve(socket_path, run, timeout=60):
+    """This method is used to serve check requests on a unix socket until terminated
+
+    :param socket_path: Path of the unix socket to listen on
+    :param run: Callable receiving the launcher argv of a single check
+    :param timeout: Seconds after which the child executing a check is killed
+    """
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(socket_path)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    with _CheckServer(socket_path, run, timeout) as server:
+        os.chmod(socket_path, 0o660)
+        try:
+            server.serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(socket_path)
+
+
+def forward(socket_path, argv, timeout=60):
+    """This method is used to run a check on a server started with serve
+
+    The output of the check is written to stdout and stderr as if it had been executed locally.
+
+    :param socket_path: Path of the unix socket the server listens on
+    :param argv: Launcher arguments of the check
+    :param timeout: Seconds to wait for the result
+    :return: Exit code of the check
+    :raises OSError: If the server is not reachable
+    :raises CheckAborted: If the check doesn't finish in time or the server kills it
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        try:
+            sock.sendall(json.dumps({"argv": argv}).encode("utf-8") + b"\n")
+            sock.shutdown(socket.SHUT_WR)
+            with sock.makefile("rb") as reader:
+                data = reader.read()
+        except socket.timeout:
+            raise CheckAborted(f"Check did not finish within {timeout} seconds")
+    if not data:
+        raise CheckAborted("Check was aborted by the server")
+    response = json.loads(data)
+    if "stdout_base64" in response:
+        sys.stdout.flush()
+        sys.stdout.buffer.write(base64.b64decode(response["stdout_base64"]))
+        sys.stdout.buffer.flush()
+    else:
+        sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    return response["exit_code"]
@@ -0,0 +1,68 @@
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+
+def process_age():
+    """Returns the seconds since the kernel started this process or None if it can't be determined"""
+    try:
+        with open("/proc/self/stat") as fh:
+            # The command name may contain spaces, so the fields are split after its closing parenthesis
+            fields = fh.read().rpartition(")")[2].split()
+        started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - started
+    except (OSError, AttributeError, ValueError, IndexError):
+        return None
+
+
+class StartupReport:
+    """Collects where the time of a launcher run is spent, see --startup-report
+
+    Phases are measured from one mark to the next, the time spent parsing arguments is
+    measured separately and subtracted from the phase it was spent in.
+    """
+
+    def __init__(self, started):
+        now = time.perf_counter()
+        age = process_age()
+        # Everything before the launcher module started executing: exec, interpreter setup and site
+        self.phases = {"interpreter": max(age - (now - started), 0) if age is not None else None}
+        self.phases["launcher"] = now - started
+        self.argparse = 0
+        self._last = now
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self._last
+        self._last = now
+
+    @contextlib.contextmanager
+    def measure_argparse(self):
+        original = argparse.ArgumentParser.parse_known_args
+
+        def parse_known_args(parser, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(parser, *args, **kwargs)
+            finally:
+                self.argparse += time.perf_counter() - start
+
+        argparse.ArgumentParser.parse_known_args = parse_known_args
+        try:
+            yield
+        finally:
+            argparse.ArgumentParser.parse_known_args = original
+
+    def print(self, file=None):
+        file = file or sys.stderr
+        phases = dict(self.phases)
+        # Arguments are parsed by the plugin, so they are reported apart from the rest of its execution
+        execute = phases.pop("execute", 0) - self.argparse
+        phases["argparse"] = self.argparse
+        phases["execute"] = execute
+        print("Startup report (ms):", file=file)
+        for phase, duration in phases.items():
+            print(f"  {phase:15} {'n/a' if duration is None else f'{duration * 1000:.1f}':>8}", file=file)
+        print(f"  {'total':15} {sum(x for x in phases.values() if x) * 1000:8.1f}", file=file)
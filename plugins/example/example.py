@@ -10,7 +10,7 @@ Provides some basic arguments to test.
 __requirements__ = []
 
 
-def execute(utils, debug=False):
+def execute(utils, debug=False, argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--hostaddress",
@@ -35,9 +35,9 @@ def execute(utils, debug=False):
         default=90,
         help="Critical threshold in percent. Default: %(default)s"
     )
-    config = parser.parse_known_args()[0]
+    config = parser.parse_known_args(argv)[0]
 
     # Write your own code here.
     # It is important to import packages, which aren't part of the standard lib, locally.
 
-    utils.build_output(state=utils.OutputState.OK, output="Example plugins returns OK")
+    return utils.build_result(state=utils.OutputState.OK, output="Example plugins returns OK")
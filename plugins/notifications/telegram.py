@@ -1,42 +1,395 @@
 import argparse
+import threading
+import time
 
 __help__ = "Send notifications via telegram to a known user."
 __requirements__ = ["requests"]
 
+# Limits of the bot API: about 30 messages per second in total and 1 message per second to the same chat
+_GLOBAL_RATE = 30
+_CHAT_RATE = 1
+# Maximum length of the text of a message
+_MESSAGE_LIMIT = 4096
+
+
+class TokenBucket:
+    """Thread safe token bucket, acquire blocks until a token is available"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0
+        self._lock = threading.Lock()
+
+    def block(self, seconds):
+        """Hand out no tokens for the given time, e.g. for retry_after of the API"""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+
+class TelegramSender:
+    """Sends messages over a pooled keep-alive session while respecting the rate limits of the bot API"""
+
+    def __init__(self, bot_token, api_url="https://api.telegram.org", timeout=10, retries=3, pool_size=8):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self._requests = requests
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._bot_token = bot_token
+        self._uri = f"{api_url.rstrip('/')}/bot{bot_token}/sendMessage"
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self._global_bucket = TokenBucket(_GLOBAL_RATE, _GLOBAL_RATE)
+        self._chat_buckets = {}
+        self._lock = threading.Lock()
+
+    def _chat_bucket(self, chat_id):
+        with self._lock:
+            if chat_id not in self._chat_buckets:
+                self._chat_buckets[chat_id] = TokenBucket(_CHAT_RATE, 1)
+            return self._chat_buckets[chat_id]
+
+    def send(self, chat_id, text):
+        """This method is used to send a message to a single chat
+
+        :param chat_id: Telegram ID of the chat
+        :param text: Message to send
+        :return: dict with chat_id, delivered, latency of the last request, attempts and error
+        """
+        chat_bucket = self._chat_bucket(chat_id)
+        result = {"chat_id": chat_id, "delivered": False, "latency": None, "attempts": 0, "error": None}
+        while result["attempts"] <= self.retries:
+            result["attempts"] += 1
+            chat_bucket.acquire()
+            self._global_bucket.acquire()
+            start = time.monotonic()
+            try:
+                response = self._session.post(
+                    self._uri, data={"chat_id": chat_id, "text": text}, timeout=self.timeout
+                )
+            except self._requests.RequestException as err:
+                # Exceptions contain the URL, which contains the token
+                result["error"] = str(err).replace(self._bot_token, "***")
+                continue
+            finally:
+                result["latency"] = round(time.monotonic() - start, 3)
+            try:
+                body = response.json()
+            except ValueError:
+                body = {}
+            if response.ok and body.get("ok", True):
+                result["delivered"] = True
+                result["error"] = None
+                return result
+            result["error"] = f"{response.status_code} {body.get('description', response.text)}"
+            if response.status_code == 429:
+                chat_bucket.block((body.get("parameters") or {}).get("retry_after", 1))
+            elif response.status_code < 500:
+                # Other client errors like an unknown chat or a blocked bot won't succeed on retry
+                return result
+        return result
+
+    def send_many(self, chat_ids, text):
+        """This method is used to send a message to multiple chats concurrently
+
+        :param chat_ids: Telegram IDs of the chats
+        :param text: Message to send
+        :return: List of dicts, see send
+        """
+        import concurrent.futures
+
+        if len(chat_ids) == 1:
+            return [self.send(chat_ids[0], text)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.pool_size, len(chat_ids))) as pool:
+            return list(pool.map(lambda x: self.send(x, text), chat_ids))
+
+    def close(self):
+        self._session.close()
+
+
+def build_delivery_result(utils, results):
+    datasets = []
+    failed = []
+    for result in results:
+        datasets.append(utils.build_dataset(name=f"{result['chat_id']}/delivered", value=int(result["delivered"])))
+        datasets.append(utils.build_dataset(name=f"{result['chat_id']}/latency", value=result["latency"], unit="s"))
+        if not result["delivered"]:
+            failed.append(f"{result['chat_id']}: {result['error']}")
+    if not failed:
+        return utils.build_result(state=utils.OutputState.OK, output="Message was sent", datasets=datasets)
+    return utils.build_result(
+        state=utils.OutputState.CRITICAL if len(failed) == len(results) else utils.OutputState.WARN,
+        output="\n".join([f"Message could not be sent to {len(failed)} of {len(results)} chats", *failed]),
+        datasets=datasets
+    )
+
 
 def send_message(config, utils, debug):
-    import requests
+    sender = TelegramSender(config.bot_token, api_url=config.api_url, timeout=config.timeout, retries=config.retries)
+    try:
+        results = sender.send_many(config.user_ids, config.message)
+    finally:
+        sender.close()
+    if debug:
+        print(results)
+    return build_delivery_result(utils, results)
+
+
+def _open_spool(utils, config):
+    return utils.Spool(config.spool_dir or utils.cache_dir("spool"), "telegram")
+
+
+def _spool_result(utils, config, stats, state, output, datasets):
+    states = [state]
+    if stats["age"] >= config.critical_age:
+        states.append(utils.OutputState.CRITICAL)
+        output = f"{output}, oldest queued message is {stats['age']:.0f}s old"
+    elif stats["age"] >= config.warning_age:
+        states.append(utils.OutputState.WARN)
+        output = f"{output}, oldest queued message is {stats['age']:.0f}s old"
+    return utils.build_result(
+        state=utils.worst_state(states),
+        output=output,
+        datasets=[
+            *datasets,
+            utils.build_dataset(name="Spool depth", value=stats["depth"]),
+            utils.build_dataset(name="Spool age", value=stats["age"], unit="s"),
+        ]
+    )
+
+
+def enqueue_message(config, utils, debug):
+    spool = _open_spool(utils, config)
+    try:
+        for user_id in config.user_ids:
+            spool.enqueue(
+                {"bot_token": config.bot_token, "api_url": config.api_url, "chat_id": user_id, "text": config.message},
+                group_key=f"{config.api_url}|{config.bot_token}|{user_id}"
+            )
+        stats = spool.stats()
+    finally:
+        spool.close()
+    return _spool_result(utils, config, stats, utils.OutputState.OK, "Message was queued", [])
 
-    uri = f"https://api.telegram.org/bot{config.bot_token}/sendMessage"
-    data_dict = {
-        "chat_id": config.user_id,
-        "text": config.message,
-    }
-    requests.post(uri, data=data_dict)
 
+def flush_spool(config, utils, debug):
+    import concurrent.futures
 
-def execute(utils, debug=False):
+    deadline = time.monotonic() + config.max_runtime
+    # Entries are leased long enough to survive all retries of the sender
+    lease = (config.timeout + 1) * (config.retries + 1) * 2
+    senders = {}
+    senders_lock = threading.Lock()
+    sent = failed = dropped = requests_sent = 0
+    spool = _open_spool(utils, config)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=config.concurrency) as pool:
+            while time.monotonic() < deadline:
+                entries = spool.claim(config.batch_size, lease, window=config.coalesce_window)
+                if not entries:
+                    break
+                if config.coalesce_window > 0:
+                    # All messages to the same chat are merged into one digest
+                    groups = {}
+                    for entry in entries:
+                        groups.setdefault(entry.group_key, []).append(entry)
+                    batches = list(groups.values())
+                else:
+                    batches = [[x] for x in entries]
+
+                def deliver(batch):
+                    payload = batch[0].payload
+                    key = (payload["api_url"], payload["bot_token"])
+                    with senders_lock:
+                        if key not in senders:
+                            senders[key] = TelegramSender(
+                                key[1], api_url=key[0], timeout=config.timeout, retries=config.retries,
+                                pool_size=config.concurrency
+                            )
+                        sender = senders[key]
+                    text = utils.build_digest([x.payload["text"] for x in batch], _MESSAGE_LIMIT)
+                    return batch, sender.send(payload["chat_id"], text)
+
+                delivered, retry, drop = [], [], []
+                for batch, result in pool.map(deliver, batches):
+                    if debug:
+                        print([x.id for x in batch], result)
+                    requests_sent += result["attempts"]
+                    if result["delivered"]:
+                        delivered.extend(x.id for x in batch)
+                    for entry in batch if not result["delivered"] else []:
+                        if entry.attempts >= config.max_attempts:
+                            drop.append(entry.id)
+                        else:
+                            retry.append(entry)
+                spool.ack(delivered + drop)
+                for entry in retry:
+                    # Back off exponentially, so an unavailable API isn't hammered
+                    spool.release([entry.id], delay=min(2 ** entry.attempts, 600))
+                sent += len(delivered)
+                failed += len(retry)
+                dropped += len(drop)
+                if retry and not delivered:
+                    # The API seems to be unavailable, try again on the next flush
+                    break
+        stats = spool.stats()
+    finally:
+        spool.close()
+        for sender in senders.values():
+            sender.close()
+    return _spool_result(
+        utils, config, stats,
+        utils.OutputState.WARN if dropped else utils.OutputState.OK,
+        f"Sent {sent} queued messages, {failed} failed, {dropped} dropped",
+        [
+            utils.build_dataset(name="Sent", value=sent),
+            utils.build_dataset(name="Failed", value=failed),
+            utils.build_dataset(name="Dropped", value=dropped),
+            utils.build_dataset(name="Requests", value=requests_sent),
+        ]
+    )
+
+
+def execute(utils, debug=False, argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "--user-id",
+        "--mode",
+        choices=["send", "enqueue", "flush"],
         action="store",
-        dest="user_id",
-        required=True,
-        help="Telegram ID of the specified user."
+        dest="mode",
+        default="send",
+        help="send delivers immediately, enqueue adds the message to the spool and flush delivers the spool. \
+              (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--user-id",
+        action="append",
+        dest="user_ids",
+        help="Telegram ID of the specified user. May be repeated to notify multiple users."
     )
     parser.add_argument(
         "--bot-token",
         action="store",
         dest="bot_token",
-        required=True,
         help="Token of the telegram bot."
     )
     parser.add_argument(
         "--message",
         action="store",
         dest="message",
-        required=True,
         help="Message to send."
     )
-    config = parser.parse_known_args()[0]
-    send_message(config, utils, debug)
+    parser.add_argument(
+        "--api-url",
+        action="store",
+        dest="api_url",
+        default="https://api.telegram.org",
+        help="URL of the bot API. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--timeout",
+        action="store",
+        dest="timeout",
+        type=float,
+        default=10,
+        help="Timeout of a single request in seconds. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--retries",
+        action="store",
+        dest="retries",
+        type=int,
+        default=3,
+        help="Number of retries on rate limits and server errors. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--spool-dir",
+        action="store",
+        dest="spool_dir",
+        help="Directory of the spool used by enqueue and flush. (default: spool in the cache directory of utils)"
+    )
+    parser.add_argument(
+        "--batch-size",
+        action="store",
+        dest="batch_size",
+        type=int,
+        default=100,
+        help="Number of messages claimed from the spool at once. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--concurrency",
+        action="store",
+        dest="concurrency",
+        type=int,
+        default=8,
+        help="Number of messages of the spool sent at the same time. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--coalesce-window",
+        action="store",
+        dest="coalesce_window",
+        type=float,
+        default=0,
+        help="Seconds flush waits after the first queued message to a chat, before all queued messages \
+              to the chat are sent as a single digest. Disabled with 0 (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--max-attempts",
+        action="store",
+        dest="max_attempts",
+        type=int,
+        default=10,
+        help="Number of flushes a message is tried before it is dropped. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--max-runtime",
+        action="store",
+        dest="max_runtime",
+        type=float,
+        default=60,
+        help="Seconds after which flush stops claiming further messages. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--warning-age",
+        action="store",
+        dest="warning_age",
+        type=float,
+        default=300,
+        help="Warning threshold for the age of the oldest queued message in seconds. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--critical-age",
+        action="store",
+        dest="critical_age",
+        type=float,
+        default=900,
+        help="Critical threshold for the age of the oldest queued message in seconds. (default: %(default)s)"
+    )
+    config = parser.parse_known_args(argv)[0]
+    if config.mode == "flush":
+        return flush_spool(config, utils, debug)
+    if not config.user_ids or not config.bot_token or config.message is None:
+        parser.error("the following arguments are required: --user-id, --bot-token, --message")
+    if config.mode == "enqueue":
+        return enqueue_message(config, utils, debug)
+    return send_message(config, utils, debug)
@@ -1,88 +1,426 @@
 import argparse
+import math
+import time
 
 __help__ = "A plugin to check a host with ICMP, broadly known as ping"
 __requirements__ = ["icmplib"]
 
 
-def send_ping(utils, debug, config):
-    from icmplib import ping
-    result = ping(
-        config.hostaddress,
-        privileged=False,
-        count=config.count,
-        source=config.source,
-        interval=config.interval,
-        family=None if not config.ipv4 and not config.ipv6 else 4 if config.ipv4 else 6
-    )
-    if debug:
-        print(result)
+# Networks with more addresses are most likely a typo and would exhaust memory
+_MAX_NETWORK_HOSTS = 65536
 
-    datasets = [
+
+def expand_targets(hostaddresses, hosts_file=None):
+    """This method is used to build the list of targets out of hosts, networks and a file of them
+
+    :param hostaddresses: List of hostnames, IPs or networks in CIDR notation
+    :param hosts_file: Optional path to a file with one target per line
+    :return: List of unique targets
+    """
+    import ipaddress
+
+    values = list(hostaddresses or [])
+    if hosts_file:
+        with open(hosts_file) as fh:
+            values.extend(x.split("#")[0].strip() for x in fh)
+    targets = {}
+    for value in values:
+        if not value:
+            continue
+        if "/" in value:
+            network = ipaddress.ip_network(value, strict=False)
+            if network.num_addresses > _MAX_NETWORK_HOSTS:
+                raise ValueError(f"Network {value} has more than {_MAX_NETWORK_HOSTS} addresses")
+            for address in network.hosts():
+                targets[str(address)] = None
+        else:
+            targets[value] = None
+    return list(targets)
+
+
+class ProbeStats:
+    """Round-trip times of the probes sent to a host, a streaming replacement of icmplib.Host
+
+    RTTs are recorded in a histogram instead of a list, so memory doesn't grow with the number of probes.
+    """
+
+    def __init__(self, utils, address):
+        self.address = address
+        self.packets_sent = 0
+        # Resolution of the hostname with the resolver of utils
+        self.resolution = None
+        self.histogram = utils.LatencyHistogram()
+        self._previous = None
+        self._deltas = 0.0
+
+    @classmethod
+    def from_host(cls, utils, host):
+        stats = cls(utils, host.address)
+        stats.packets_sent = host.packets_sent
+        for rtt in host.rtts:
+            stats.record(rtt)
+        return stats
+
+    def record(self, rtt):
+        self.histogram.record(rtt)
+        if self._previous is not None:
+            self._deltas += abs(rtt - self._previous)
+        self._previous = rtt
+
+    @property
+    def packets_received(self):
+        return self.histogram.count
+
+    @property
+    def is_alive(self):
+        return self.histogram.count > 0
+
+    @property
+    def packet_loss(self):
+        if not self.packets_sent:
+            return 0.0
+        return round(1 - self.histogram.count / self.packets_sent, 2)
+
+    @property
+    def min_rtt(self):
+        return round(self.histogram.min, 3) if self.is_alive else 0.0
+
+    @property
+    def avg_rtt(self):
+        return round(self.histogram.mean, 3) if self.is_alive else 0.0
+
+    @property
+    def max_rtt(self):
+        return round(self.histogram.max, 3) if self.is_alive else 0.0
+
+    @property
+    def jitter(self):
+        # Mean difference of consecutive RTTs, as calculated by icmplib
+        return round(self._deltas / (self.histogram.count - 1), 3) if self.histogram.count > 1 else 0.0
+
+    def rtt(self, metric):
+        """Returns the RTT selected with --rta-metric: avg, p50, p95 or p99"""
+        if metric == "avg":
+            return self.avg_rtt
+        value = self.histogram.percentile(float(metric[1:]))
+        return round(value, 3) if value is not None else 0.0
+
+    def __repr__(self):
+        return f"ProbeStats(address={self.address!r}, packets_sent={self.packets_sent}, " \
+               f"packets_received={self.packets_received}, avg_rtt={self.avg_rtt})"
+
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid number {value}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive number")
+    return number
+
+
+def bucket_bounds(value):
+    try:
+        return sorted(float(x) for x in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid bucket bounds {value}")
+
+
+def _build_datasets(utils, host, prefix=""):
+    return [
         utils.build_dataset(
-            name="packetloss", value=int(result.packet_loss * 100)
+            name=f"{prefix}packetloss", value=int(host.packet_loss * 100)
         ),
         utils.build_dataset(
-            name="min_rtt", value=result.min_rtt
+            name=f"{prefix}min_rtt", value=host.min_rtt
         ),
         utils.build_dataset(
-            name="avg_rtt", value=result.avg_rtt
+            name=f"{prefix}avg_rtt", value=host.avg_rtt
         ),
         utils.build_dataset(
-            name="max_rtt", value=result.max_rtt
+            name=f"{prefix}max_rtt", value=host.max_rtt
         ),
         utils.build_dataset(
-            name="jitter", value=result.jitter
+            name=f"{prefix}jitter", value=host.jitter
         )
     ]
 
-    if not result.is_alive:
-        utils.build_output(
-            state=utils.OutputState.CRITICAL,
-            output=f"{config.hostaddress} is not reachable",
-            datasets=datasets
-        )
 
-    if int(result.packet_loss*100) >= config.critical_packetloss:
-        utils.build_output(
-            state=utils.OutputState.CRITICAL,
-            output=f"Packetloss critical: {int(result.packet_loss*100)}",
-            datasets=datasets
-        )
-    elif int(result.packet_loss*100) >= config.warning_packetloss:
-        utils.build_output(
-            state=utils.OutputState.WARN,
-            output=f"Packetloss warn: {int(result.packet_loss*100)}",
-            datasets=datasets
-        )
+def _build_dns_datasets(utils, resolutions, duration):
+    # IP addresses aren't resolved and have no cache state
+    resolved = [x for x in resolutions if x.cached is not None]
+    if not resolved:
+        return []
+    return [
+        utils.build_dataset(name="dns_time", value=round(duration * 1000, 3)),
+        utils.build_dataset(name="dns_cache_hits", value=sum(1 for x in resolved if x.cached)),
+    ]
 
-    if result.avg_rtt >= config.critical_rta:
-        utils.build_output(
-            state=utils.OutputState.CRITICAL,
-            output=f"RTA critical: {result.avg_rtt} ms",
-            datasets=datasets
-        )
-    elif result.avg_rtt >= config.warning_rta:
-        utils.build_output(
-            state=utils.OutputState.WARN,
-            output=f"RTA warn: {result.avg_rtt} ms",
-            datasets=datasets
+
+def _address_family(config):
+    import socket
+
+    return socket.AF_INET if config.ipv4 else socket.AF_INET6 if config.ipv6 else 0
+
+
+def _build_distribution_datasets(utils, config, host):
+    datasets = [
+        utils.build_dataset(name=f"p{percentile}_rtt", value=round(value, 3) if value is not None else 0.0)
+        for percentile, value in zip((50, 95, 99), host.histogram.percentiles((50, 95, 99)))
+    ]
+    # Cumulative like the buckets of a Prometheus histogram
+    for bound, count in zip(config.rtt_buckets, host.histogram.count_below(config.rtt_buckets)):
+        datasets.append(utils.build_dataset(name=f"rtt_le_{bound:g}", value=count))
+    return datasets
+
+
+def _evaluate(utils, config, target, host):
+    if not host.is_alive:
+        return utils.OutputState.CRITICAL, f"{target} is not reachable"
+
+    if int(host.packet_loss*100) >= config.critical_packetloss:
+        return utils.OutputState.CRITICAL, f"Packetloss critical: {int(host.packet_loss*100)}"
+    elif int(host.packet_loss*100) >= config.warning_packetloss:
+        return utils.OutputState.WARN, f"Packetloss warn: {int(host.packet_loss*100)}"
+
+    rta = host.rtt(config.rta_metric)
+    label = "RTA" if config.rta_metric == "avg" else f"RTT {config.rta_metric}"
+    if rta >= config.critical_rta:
+        return utils.OutputState.CRITICAL, f"{label} critical: {rta} ms"
+    elif rta >= config.warning_rta:
+        return utils.OutputState.WARN, f"{label} warn: {rta} ms"
+
+    return utils.OutputState.OK, f"Ping OK, {label}: {rta} ms"
+
+
+def _severity(value, warning, critical):
+    return 2 if value >= critical else 1 if value >= warning else 0
+
+
+def _decided(config, stats):
+    """Returns whether the probes left of --count can't change the state _evaluate returns anymore
+
+    Remaining probes are assumed to be either lost or answered after 0 ms up to --critical-rta.
+    A slower answer is already critical on its own, so it isn't waited for.
+    """
+    remaining = config.count - stats.packets_sent
+    if remaining <= 0:
+        return True
+    received = stats.packets_received
+    # Packet loss in percent if all remaining probes are answered and if all of them are lost
+    best, worst = (
+        _severity(int(round(1 - x / config.count, 2) * 100), config.warning_packetloss, config.critical_packetloss)
+        for x in (received + remaining, received)
+    )
+    if not received:
+        worst = 2
+    severities = set(range(max(best, 1), worst + 1))
+    if best == 0:
+        # The widest range of the RTT results if all remaining probes are answered
+        bound = min(config.timeout * 1000, config.critical_rta)
+        total = received + remaining
+        if config.rta_metric == "avg":
+            lowest = stats.histogram.sum / total
+            highest = (stats.histogram.sum + remaining * bound) / total
+        else:
+            rank = max(math.ceil(float(config.rta_metric[1:]) / 100 * total), 1)
+            lowest, highest = stats.histogram.values_at_ranks([rank - remaining, rank])
+            lowest = lowest or 0.0
+            highest = bound if highest is None else highest
+        severities.update(range(
+            _severity(lowest, config.warning_rta, config.critical_rta),
+            _severity(highest, config.warning_rta, config.critical_rta) + 1
+        ))
+    return len(severities) == 1
+
+
+def _apply_history(utils, config, host, state, output):
+    """Records the result in the history of the host and evaluates flapping and the RTT trend
+
+    :return: Tuple of state, output and datasets
+    """
+    with utils.open_history(
+            f"protocols.icmp:{config.hostaddress}", ["rtt", "packetloss"], config.history_size
+    ) as history:
+        history.append(state, {"rtt": host.rtt(config.rta_metric), "packetloss": int(host.packet_loss * 100)})
+        flapping = history.flapping()
+        average = history.moving_average("rtt")
+        trend = history.rate_of_change("rtt")
+    datasets = [utils.build_dataset(name="flapping", value=round(flapping, 1))]
+    if average is not None:
+        datasets.append(utils.build_dataset(name="rtt_moving_average", value=round(average, 3)))
+    if trend is not None:
+        datasets.append(utils.build_dataset(name="rtt_trend", value=round(trend * 60, 3)))
+
+    states = [state]
+    outputs = [output]
+    if flapping >= config.flapping_threshold:
+        states.append(utils.OutputState.WARN)
+        outputs.append(f"flapping {flapping:.0f}%")
+    if config.warning_rtt_trend is not None and trend is not None and trend * 60 >= config.warning_rtt_trend:
+        states.append(utils.OutputState.WARN)
+        outputs.append(f"RTT rising by {trend * 60:.3f} ms/min")
+    return utils.worst_state(states), ", ".join(outputs), datasets
+
+
+def probe(utils, config):
+    """This method is used to ping a host, recording the RTTs without keeping them
+
+    Works like icmplib.ping, but in constant memory for any --count.
+    With --adaptive no more probes are sent as soon as the state is decided.
+
+    :return: ProbeStats
+    """
+    from icmplib import PID, ICMPLibError, ICMPRequest, ICMPv4Socket, ICMPv6Socket
+    from icmplib import is_ipv6_address
+
+    resolution = utils.get_resolver().resolve(config.hostaddress, _address_family(config))
+    address = resolution.addresses[0][1][0]
+    socket_class = ICMPv6Socket if is_ipv6_address(address) else ICMPv4Socket
+    stats = ProbeStats(utils, address)
+    stats.resolution = resolution
+    with socket_class(config.source, privileged=False) as sock:
+        for sequence in range(config.count):
+            if sequence:
+                time.sleep(config.interval)
+            # The sequence number has 16 bits
+            request = ICMPRequest(destination=address, id=PID & 0xffff, sequence=sequence & 0xffff)
+            try:
+                sock.send(request)
+                stats.packets_sent += 1
+                reply = sock.receive(request, config.timeout)
+                reply.raise_for_status()
+                stats.record((reply.time - request.time) * 1000)
+            except ICMPLibError:
+                pass
+            if config.adaptive and _decided(config, stats):
+                break
+    return stats
+
+
+def send_ping(utils, debug, config):
+    import socket
+
+    try:
+        result = probe(utils, config)
+    except socket.gaierror as err:
+        return utils.build_result(
+            state=utils.OutputState.CRITICAL, output=f"{config.hostaddress} could not be resolved: {err}"
         )
+    if debug:
+        print(result)
+
+    state, output = _evaluate(utils, config, config.hostaddress, result)
+    history_datasets = []
+    if config.history:
+        state, output, history_datasets = _apply_history(utils, config, result, state, output)
+    return utils.build_result(
+        state=state,
+        output=output,
+        datasets=[
+            *_build_datasets(utils, result),
+            *_build_distribution_datasets(utils, config, result),
+            utils.build_dataset(name="probes_sent", value=result.packets_sent),
+            *_build_dns_datasets(utils, [result.resolution], result.resolution.duration),
+            *history_datasets
+        ]
+    )
+
+
+def _resolve_targets(utils, config, targets):
+    """Resolves the targets concurrently with the resolver of utils
+
+    :return: Tuple of the list of resolutions, None for targets which couldn't be resolved, and the duration
+    """
+    import concurrent.futures
+    import socket
+
+    resolver = utils.get_resolver()
+    family = _address_family(config)
+
+    def resolve(target):
+        try:
+            return resolver.resolve(target, family)
+        except socket.gaierror:
+            return None
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.concurrency) as pool:
+        resolutions = list(pool.map(resolve, targets))
+    resolver.flush()
+    return resolutions, time.monotonic() - start
+
+
+def sweep(utils, debug, config, targets):
+    from icmplib import multiping
+
+    resolutions, dns_duration = _resolve_targets(utils, config, targets)
+    addresses = [x.addresses[0][1][0] for x in resolutions if x]
+    results = iter(multiping(
+        addresses,
+        privileged=False,
+        count=config.count,
+        source=config.source,
+        interval=config.interval,
+        timeout=config.timeout,
+        concurrent_tasks=config.concurrency,
+        family=None if not config.ipv4 and not config.ipv6 else 4 if config.ipv4 else 6
+    ) if addresses else [])
+
+    states = []
+    problems = []
+    alive = 0
+    datasets = []
+    for target, resolution in zip(targets, resolutions):
+        if resolution is None:
+            states.append(utils.OutputState.CRITICAL)
+            problems.append(f"{target}: {target} could not be resolved")
+            continue
+        host = next(results)
+        if debug:
+            print(host)
+        alive += host.is_alive
+        state, output = _evaluate(utils, config, target, ProbeStats.from_host(utils, host))
+        states.append(state)
+        if state != utils.OutputState.OK:
+            problems.append(f"{target}: {output}")
+        datasets.extend(_build_datasets(utils, host, prefix=f"{target}/"))
+    datasets[:0] = [
+        utils.build_dataset(name="hosts_total", value=len(targets)),
+        utils.build_dataset(name="hosts_alive", value=alive),
+        *_build_dns_datasets(utils, [x for x in resolutions if x], dns_duration),
+    ]
 
-    utils.build_output(
-        state=utils.OutputState.OK,
-        output=f"Ping OK, RTA: {result.avg_rtt} ms",
+    ok_count = states.count(utils.OutputState.OK)
+    return utils.build_result(
+        state=utils.worst_state(states),
+        output="\n".join([f"{ok_count}/{len(targets)} hosts OK", *problems]),
         datasets=datasets
     )
 
 
-def execute(utils, debug):
+def execute(utils, debug=False, argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--hostaddress", "-H",
+        action="append",
+        dest="hostaddresses",
+        help="Hostname, IP, domain or network in CIDR notation of the target. May be repeated"
+    )
+    parser.add_argument(
+        "--hosts-file",
+        action="store",
+        dest="hosts_file",
+        help="File with one hostname, IP, domain or network per line"
+    )
+    parser.add_argument(
+        "--concurrency",
         action="store",
-        dest="hostaddress",
-        required=True,
-        help="Hostname, IP or domain of the target"
+        dest="concurrency",
+        type=int,
+        default=50,
+        help="Maximum number of targets pinged at the same time. (default: %(default)s)"
     )
     parser.add_argument(
         "--count",
@@ -90,7 +428,16 @@ def execute(utils, debug):
         dest="count",
         type=int,
         default=3,
-        help="Number of pings to perform. (default: %(default)s)"
+        help="Number of pings to perform, the maximum with --adaptive. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        dest="adaptive",
+        help="Stop pinging a single host as soon as the remaining pings can't change the state anymore, \
+              assuming each of them may be lost or answered after up to --critical-rta. \
+              A healthy host still needs enough pings that losing all remaining ones stays below \
+              --warning-packetloss, and with a percentile --rta-metric until its rank is received"
     )
     parser.add_argument(
         "--source",
@@ -159,5 +506,60 @@ def execute(utils, debug):
         default=500,
         help="Critical threshold of the round-travel-average in ms. (default: %(default)s)"
     )
-    c = parser.parse_known_args()[0]
-    send_ping(utils, debug, c)
+    parser.add_argument(
+        "--rta-metric",
+        action="store",
+        dest="rta_metric",
+        choices=["avg", "p50", "p95", "p99"],
+        default="avg",
+        help="RTT the rta thresholds are applied to, the average or a percentile. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--rtt-buckets",
+        action="store",
+        dest="rtt_buckets",
+        type=bucket_bounds,
+        default="0.5,1,2,5,10,20,50,100,200,500,1000",
+        help="Comma separated upper bounds in ms of the RTT histogram datasets of a single host. \
+              (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--history",
+        action="store_true",
+        dest="history",
+        help="Keep the results of a single host in the cache directory to detect flapping and RTT trends"
+    )
+    parser.add_argument(
+        "--history-size",
+        action="store",
+        dest="history_size",
+        type=positive_int,
+        default=60,
+        help="Number of results the history keeps. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--flapping-threshold",
+        action="store",
+        dest="flapping_threshold",
+        type=float,
+        default=50,
+        help="Percent of state changes in the history at which the state is at least warn. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--warning-rtt-trend",
+        action="store",
+        dest="warning_rtt_trend",
+        type=float,
+        help="Warning threshold of the increase of the RTT over the history in ms per minute"
+    )
+    c = parser.parse_known_args(argv)[0]
+    if not c.hostaddresses and not c.hosts_file:
+        parser.error("the following arguments are required: --hostaddress or --hosts-file")
+    try:
+        targets = expand_targets(c.hostaddresses, c.hosts_file)
+    except (OSError, ValueError) as err:
+        return utils.build_result(state=utils.OutputState.UNKNOWN, output=f"Invalid targets: {err}")
+    if len(targets) == 1 and not c.hosts_file:
+        c.hostaddress = targets[0]
+        return send_ping(utils, debug, c)
+    return sweep(utils, debug, c, targets)
@@ -1,21 +1,211 @@
 import argparse
-import smtplib
-import socket
+import copy
+import functools
+import importlib
+import os
 import time
-from datetime import datetime, timedelta
 
 __help__ = "Module to check smtp"
 __requirements__ = ["cryptography"]
 
 
-def add_common_args(parser):
-    parser.add_argument(
-        "--hostaddress", "-H",
-        action="store",
-        dest="hostaddress",
-        required=True,
-        help="Hostname, IP or domain of the target"
-    )
+# Protocol phases measured by the timed clients and their names in datasets
+PHASES = {
+    "dns": "DNS",
+    "tcp": "TCP",
+    "tls": "TLS",
+    "banner": "Banner",
+    "ehlo": "EHLO",
+    "starttls": "STARTTLS",
+    "auth": "AUTH",
+}
+
+
+@functools.lru_cache(maxsize=None)
+def client_classes():
+    """Defines the timed SMTP clients on first use, so smtplib is only imported by modes connecting to a server
+
+    :return: Tuple of TimedSMTP and TimedSMTP_SSL
+    """
+    import smtplib
+    import socket
+
+    class TimedSMTP(smtplib.SMTP):
+        """smtplib.SMTP recording the duration of every protocol phase in seconds
+
+        The constructor doesn't connect, connect has to be called explicitly.
+        Hostnames are resolved with the resolver of utils.
+        """
+
+        def __init__(self, hostname, resolver, **kwargs):
+            super().__init__(**kwargs)
+            # Used as server_hostname for TLS, smtplib only sets it if the constructor connects
+            self._host = hostname
+            self.resolver = resolver
+            self.phases = {}
+            self.dns_cached = None
+
+        def _measure(self, phase, func, *args, **kwargs):
+            start = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.phases[phase] = self.phases.get(phase, 0) + time.monotonic() - start
+
+        def _open_socket(self, addresses, timeout):
+            error = None
+            for family, sock_type, proto, _, address in addresses:
+                sock = socket.socket(family, sock_type, proto)
+                try:
+                    sock.settimeout(timeout)
+                    if self.source_address:
+                        sock.bind(self.source_address)
+                    sock.connect(address)
+                    return sock
+                except OSError as err:
+                    error = err
+                    sock.close()
+            raise error
+
+        def _get_socket(self, host, port, timeout):
+            resolution = self._measure("dns", self.resolver.resolve, host)
+            self.dns_cached = resolution.cached
+            sock = self._measure("tcp", self._open_socket, resolution.addrinfo(port), timeout)
+            if isinstance(self, smtplib.SMTP_SSL):
+                sock = self._measure("tls", self.context.wrap_socket, sock, server_hostname=self._host)
+            return sock
+
+        def connect(self, host="localhost", port=0, source_address=None):
+            start = time.monotonic()
+            try:
+                return super().connect(host, port, source_address)
+            finally:
+                # Everything not spent on resolving, connecting or the handshake was spent waiting for the banner
+                connected = sum(self.phases.get(x, 0) for x in ("dns", "tcp", "tls"))
+                self.phases["banner"] = max(time.monotonic() - start - connected, 0)
+
+        def ehlo(self, name=""):
+            return self._measure("ehlo", super().ehlo, name)
+
+        def starttls(self, *args, **kwargs):
+            self.ehlo_or_helo_if_needed()
+            return self._measure("starttls", super().starttls, *args, **kwargs)
+
+        def login(self, user, password, **kwargs):
+            self.ehlo_or_helo_if_needed()
+            return self._measure("auth", super().login, user, password, **kwargs)
+
+    class TimedSMTP_SSL(TimedSMTP, smtplib.SMTP_SSL):
+        pass
+
+    return TimedSMTP, TimedSMTP_SSL
+
+
+def open_client(utils, config):
+    timed_smtp, timed_smtp_ssl = client_classes()
+    client_class = timed_smtp_ssl if config.ssl else timed_smtp
+    return client_class(config.hostaddress, utils.get_resolver(), timeout=config.timeout)
+
+
+def connect_client(client, config):
+    import smtplib
+
+    code, msg = client.connect(config.hostaddress, config.port)
+    if code != 220:
+        client.close()
+        raise smtplib.SMTPConnectError(code, msg)
+    return code, msg
+
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid number {value}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive number")
+    return number
+
+
+def phase_threshold(value):
+    phase, _, seconds = value.partition("=")
+    if phase not in PHASES:
+        raise argparse.ArgumentTypeError(f"Unknown phase {phase}")
+    try:
+        return phase, float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid threshold {seconds}")
+
+
+def build_phase_result(utils, config, client, *, state, output, datasets=None):
+    """Adds the phase durations of client to the result, applies the phase thresholds and records the history"""
+    states = [state]
+    outputs = [output]
+    datasets = list(datasets or [])
+    warning = dict(config.warning_phase)
+    critical = dict(config.critical_phase)
+    phases = client.phases if client else {}
+    for phase, duration in phases.items():
+        datasets.append(utils.build_dataset(name=f"{PHASES[phase]} time", value=round(duration, 4)))
+        if phase in critical and duration >= critical[phase]:
+            states.append(utils.OutputState.CRITICAL)
+            outputs.append(f"{PHASES[phase]} took {duration:.3f}s")
+        elif phase in warning and duration >= warning[phase]:
+            states.append(utils.OutputState.WARN)
+            outputs.append(f"{PHASES[phase]} took {duration:.3f}s")
+    # Not reported for IP addresses, which aren't resolved
+    if client and client.dns_cached is not None:
+        datasets.append(utils.build_dataset(name="DNS cache hit", value=int(client.dns_cached)))
+    if config.history:
+        with utils.open_history(
+                f"protocols.smtp:{config.mode}:{config.hostaddress}:{config.port}", ["connection"], config.history_size
+        ) as history:
+            # Results answered from the certificate cache didn't connect and have no duration
+            history.append(utils.worst_state(states), {"connection": sum(phases.values())} if phases else {})
+            flapping = history.flapping()
+            average = history.moving_average("connection")
+            trend = history.rate_of_change("connection")
+        datasets.append(utils.build_dataset(name="Flapping", value=round(flapping, 1)))
+        if average is not None:
+            datasets.append(utils.build_dataset(name="Connection time average", value=round(average, 4)))
+        if trend is not None:
+            datasets.append(utils.build_dataset(name="Connection time trend", value=round(trend * 60, 4)))
+        if flapping >= config.flapping_threshold:
+            states.append(utils.OutputState.WARN)
+            outputs.append(f"flapping {flapping:.0f}%")
+    return utils.build_result(state=utils.worst_state(states), output=", ".join(outputs), datasets=datasets)
+
+
+def add_common_args(parser, multiple_targets=False):
+    if multiple_targets:
+        parser.add_argument(
+            "--hostaddress", "-H",
+            action="append",
+            dest="hostaddresses",
+            help="Hostname, IP or domain of the target, optionally with :PORT. May be repeated"
+        )
+        parser.add_argument(
+            "--targets-file",
+            action="store",
+            dest="targets_file",
+            help="File with one hostname, IP or domain per line, optionally with :PORT"
+        )
+        parser.add_argument(
+            "--concurrency",
+            action="store",
+            dest="concurrency",
+            type=int,
+            default=100,
+            help="Maximum number of targets checked at the same time. (default: %(default)s)"
+        )
+    else:
+        parser.add_argument(
+            "--hostaddress", "-H",
+            action="store",
+            dest="hostaddress",
+            required=True,
+            help="Hostname, IP or domain of the target"
+        )
     parser.add_argument(
         "--port", "-p",
         action="store",
@@ -32,11 +222,128 @@ def add_common_args(parser):
         default=10,
         help="Default timeout for connection attempt. (default: %(default)s)"
     )
+    parser.add_argument(
+        "--warning-phase",
+        action="append",
+        dest="warning_phase",
+        type=phase_threshold,
+        default=[],
+        metavar="PHASE=SECONDS",
+        help=f"Warning threshold for the duration of a protocol phase, may be repeated. \
+               Phases: {', '.join(PHASES)}"
+    )
+    parser.add_argument(
+        "--critical-phase",
+        action="append",
+        dest="critical_phase",
+        type=phase_threshold,
+        default=[],
+        metavar="PHASE=SECONDS",
+        help="Critical threshold for the duration of a protocol phase, may be repeated"
+    )
+    parser.add_argument(
+        "--history",
+        action="store_true",
+        dest="history",
+        help="Keep the results of every target in the cache directory to detect flapping"
+    )
+    parser.add_argument(
+        "--history-size",
+        action="store",
+        dest="history_size",
+        type=positive_int,
+        default=60,
+        help="Number of results the history keeps. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--flapping-threshold",
+        action="store",
+        dest="flapping_threshold",
+        type=float,
+        default=50,
+        help="Percent of state changes in the history at which the state is at least warn. (default: %(default)s)"
+    )
+    # Parsed by execute, part of the identity of the history
+    parser.add_argument("--mode", dest="mode", help=argparse.SUPPRESS)
+
+
+def add_expiry_args(parser):
+    parser.add_argument(
+        "--warning-expiry",
+        action="store",
+        dest="warning_expiry",
+        default=20,
+        type=int,
+        help="Warning threshold (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--critical-expiry",
+        action="store",
+        dest="critical_expiry",
+        default=10,
+        type=int,
+        help="Critical threshold (default: %(default)s)"
+    )
+
+
+def split_target(value, default_port):
+    """Splits HOST:PORT, IPv6 addresses with port have to be enclosed in brackets"""
+    if value.startswith("["):
+        host, _, port = value[1:].partition("]")
+        port = port.lstrip(":")
+    elif value.count(":") == 1:
+        host, _, port = value.partition(":")
+    else:
+        host, port = value, ""
+    return host, int(port) if port else default_port
+
 
+def parse_targets(parser, config):
+    """This method is used to build the list of targets of modes supporting multiple targets
+
+    A single --hostaddress is checked with smtplib, everything else with the asyncio engine of utils.
+    The first target is set as hostaddress and port of config.
+
+    :return: List of unique tuples of host and port
+    """
+    values = list(config.hostaddresses or [])
+    if config.targets_file:
+        try:
+            with open(config.targets_file) as fh:
+                values.extend(x.split("#")[0].strip() for x in fh)
+        except OSError as err:
+            parser.error(f"Invalid targets file: {err}")
+    try:
+        targets = list(dict.fromkeys(split_target(x, config.port) for x in values if x))
+    except ValueError as err:
+        parser.error(f"Invalid target: {err}")
+    if not targets:
+        parser.error("the following arguments are required: --hostaddress or --targets-file")
+    config.hostaddress, config.port = targets[0]
+    return targets
+
+
+def evaluate_expiry(utils, config, not_valid_after):
+    from datetime import datetime, timedelta, timezone
+
+    if not_valid_after.tzinfo is None:
+        # Certificates are valid until a time in UTC
+        not_valid_after = not_valid_after.replace(tzinfo=timezone.utc)
+    now = datetime.now(timezone.utc)
+    days = (not_valid_after - now).days
+    if (not_valid_after - (now + timedelta(days=config.critical_expiry))).total_seconds() <= 0:
+        return utils.OutputState.CRITICAL, days
+    if (not_valid_after - (now + timedelta(days=config.warning_expiry))).total_seconds() <= 0:
+        return utils.OutputState.WARN, days
+    return utils.OutputState.OK, days
+
+
+def mode_connect(utils, debug, argv):
+    import smtplib
+    import socket
 
-def mode_connect(utils, debug):
     parser = argparse.ArgumentParser()
-    add_common_args(parser)
+    add_common_args(parser, multiple_targets=True)
     parser.add_argument(
         "--start-tls",
         action="store_true",
@@ -49,40 +356,54 @@ def mode_connect(utils, debug):
         dest="ssl",
         help="Specify if SMTPS should be used"
     )
-    config = parser.parse_known_args()[0]
-    start = time.time()
+    config = parser.parse_known_args(argv)[0]
+    targets = parse_targets(parser, config)
+    if len(targets) > 1 or config.targets_file:
+        return probe_targets(utils, debug, config, "connect", targets)
+    start = time.monotonic()
+    client = open_client(utils, config)
     try:
-        if config.ssl:
-            with smtplib.SMTP_SSL(host=config.hostaddress, port=config.port, timeout=config.timeout) as client:
-                res = client.noop()
-        else:
-            with smtplib.SMTP(host=config.hostaddress, port=config.port, timeout=config.timeout) as client:
-                if config.start_tls:
-                    client.starttls()
-                res = client.noop()
-        connection_time = round(time.time() - start, 3)
+        connect_client(client, config)
+        with client:
+            if config.start_tls and not config.ssl:
+                client.starttls()
+            res = client.noop()
+        connection_time = round(time.monotonic() - start, 3)
         if res == (250, b'2.0.0 Ok'):
-            utils.build_output(
+            return build_phase_result(
+                utils, config, client,
                 state=utils.OutputState.OK, output=f"Connection to {config.hostaddress} established.",
                 datasets=[
                     utils.build_dataset(name="Connection time", value=connection_time)
                 ]
             )
         else:
-            utils.build_output(
+            return build_phase_result(
+                utils, config, client,
                 state=utils.OutputState.CRITICAL,
                 output=f"Connection to {config.hostaddress} established, but response was {str(res)}",
                 datasets=[
                     utils.build_dataset(name="Connection time", value=connection_time)
                 ]
             )
-    except smtplib.SMTPServerDisconnected:
-        utils.build_output(state=utils.OutputState.UNKNOWN, output=f"Connection to {config.hostaddress} timed out")
+    except (smtplib.SMTPServerDisconnected, socket.timeout):
+        return build_phase_result(
+            utils, config, client,
+            state=utils.OutputState.UNKNOWN, output=f"Connection to {config.hostaddress} timed out"
+        )
+    except (smtplib.SMTPConnectError, OSError) as err:
+        return build_phase_result(
+            utils, config, client,
+            state=utils.OutputState.CRITICAL, output=f"Connection to {config.hostaddress} failed: {err}"
+        )
 
 
-def mode_login(utils, debug):
+def mode_login(utils, debug, argv):
+    import smtplib
+    import socket
+
     parser = argparse.ArgumentParser()
-    add_common_args(parser)
+    add_common_args(parser, multiple_targets=True)
     parser.add_argument(
         "--smtp-user",
         action="store",
@@ -109,38 +430,56 @@ def mode_login(utils, debug):
         dest="ssl",
         help="Specify if SMTPS should be used"
     )
-    config = parser.parse_known_args()[0]
-    start = time.time()
+    config = parser.parse_known_args(argv)[0]
+    targets = parse_targets(parser, config)
+    if len(targets) > 1 or config.targets_file:
+        return probe_targets(utils, debug, config, "login", targets)
+    start = time.monotonic()
+    client = open_client(utils, config)
     try:
-        try:
-            if config.ssl:
-                with smtplib.SMTP_SSL(host=config.hostaddress, port=config.port, timeout=config.timeout) as client:
-                    res = client.login(config.smtp_user, config.smtp_password)
-            else:
-                with smtplib.SMTP(host=config.hostaddress, port=config.port, timeout=config.timeout) as client:
-                    res = client.login(config.smtp_user, config.smtp_password)
-        except smtplib.SMTPServerDisconnected:
-            utils.build_output(
-                state=utils.OutputState.UNKNOWN,
-                output=f"Connection to {config.hostaddress} timed out."
-            )
+        connect_client(client, config)
+        with client:
+            if config.start_tls and not config.ssl:
+                client.starttls()
+            res = client.login(config.smtp_user, config.smtp_password)
     except smtplib.SMTPAuthenticationError:
         # Set res to 535 as that's the code for Authentication failed in SMTP
         res = (535,)
-    connection_time = round(time.time() - start, 3)
+    except (smtplib.SMTPServerDisconnected, socket.timeout):
+        return build_phase_result(
+            utils, config, client,
+            state=utils.OutputState.UNKNOWN,
+            output=f"Connection to {config.hostaddress} timed out."
+        )
+    except (smtplib.SMTPConnectError, OSError) as err:
+        return build_phase_result(
+            utils, config, client,
+            state=utils.OutputState.CRITICAL, output=f"Connection to {config.hostaddress} failed: {err}"
+        )
+    connection_time = round(time.monotonic() - start, 3)
     if res == (235, b'2.7.0 Authentication successful'):
-        utils.build_output(
+        return build_phase_result(
+            utils, config, client,
             state=utils.OutputState.OK, output=f"Authentication successful",
             datasets=[utils.build_dataset(name="Connection time", value=connection_time)]
         )
     elif res[0] == 535:
-        utils.build_output(
+        return build_phase_result(
+            utils, config, client,
             state=utils.OutputState.CRITICAL, output="Authentication failed",
             datasets=[utils.build_dataset(name="Connection time", value=connection_time)]
         )
+    return build_phase_result(
+        utils, config, client,
+        state=utils.OutputState.UNKNOWN, output=f"Unexpected response {str(res)}",
+        datasets=[utils.build_dataset(name="Connection time", value=connection_time)]
+    )
+
 
+def mode_sendmail(utils, debug, argv):
+    import smtplib
+    import socket
 
-def mode_sendmail(utils, debug):
     parser = argparse.ArgumentParser()
     add_common_args(parser)
     parser.add_argument(
@@ -190,57 +529,130 @@ def mode_sendmail(utils, debug):
         dest="smtp_msg",
         help="Message to send in mail"
     )
-    config = parser.parse_known_args()[0]
+    config = parser.parse_known_args(argv)[0]
+    client = open_client(utils, config)
     try:
         try:
-            if config.ssl:
-                with smtplib.SMTP_SSL(host=config.hostaddress, port=config.port, timeout=config.timeout) as client:
-                    res = client.login(config.smtp_user, config.smtp_password)
-                    if res[0] == 235:
-                        res = client.sendmail(config.smtp_from, config.smtp_to, config.smtp_msg.replace("\\n", "\n"))
-                        if res == {}:
-                            utils.build_output(
-                                state=utils.OutputState.OK,
-                                output="Message was sent"
-                            )
-                        else:
-                            utils.build_output(
-                                state=utils.OutputState.UNKNOWN,
-                                output=f"Message could not be sent: {res}"
-                            )
-            else:
-                with smtplib.SMTP(host=config.hostaddress, port=config.port, timeout=config.timeout) as client:
-                    if config.start_tls:
-                        client.starttls()
-                    res = client.login(config.smtp_user, config.smtp_password)
-                    if res[0] == 235:
-                        res = client.sendmail(config.smtp_from, config.smtp_to, config.smtp_msg.replace("\\n", "\n"))
-                        if res == {}:
-                            utils.build_output(
-                                state=utils.OutputState.OK,
-                                output="Message was sent"
-                            )
-                        else:
-                            utils.build_output(
-                                state=utils.OutputState.UNKNOWN,
-                                output=f"Message could not be sent: {res}"
-                            )
+            connect_client(client, config)
+            with client:
+                if config.start_tls and not config.ssl:
+                    client.starttls()
+                res = client.login(config.smtp_user, config.smtp_password)
+                if res[0] == 235:
+                    res = client.sendmail(config.smtp_from, config.smtp_to, config.smtp_msg.replace("\\n", "\n"))
+                    if res == {}:
+                        return build_phase_result(
+                            utils, config, client,
+                            state=utils.OutputState.OK,
+                            output="Message was sent"
+                        )
+                    else:
+                        return build_phase_result(
+                            utils, config, client,
+                            state=utils.OutputState.UNKNOWN,
+                            output=f"Message could not be sent: {res}"
+                        )
         except smtplib.SMTPAuthenticationError:
-            utils.build_output(
+            return build_phase_result(
+                utils, config, client,
                 state=utils.OutputState.UNKNOWN,
                 output="Authentication failed"
             )
-    except smtplib.SMTPServerDisconnected:
-        utils.build_output(
+    except (smtplib.SMTPServerDisconnected, socket.timeout):
+        return build_phase_result(
+            utils, config, client,
             state=utils.OutputState.UNKNOWN,
             output=f"Connection to {config.hostaddress} timed out."
         )
+    except (smtplib.SMTPConnectError, OSError) as err:
+        return build_phase_result(
+            utils, config, client,
+            state=utils.OutputState.CRITICAL, output=f"Connection to {config.hostaddress} failed: {err}"
+        )
+    return build_phase_result(
+        utils, config, client,
+        state=utils.OutputState.UNKNOWN,
+        output=f"Unexpected response {str(res)}"
+    )
 
 
-def mode_certificate(utils, debug):
+def _describe_certificate(der):
     from cryptography import x509
+    from cryptography.hazmat.primitives import hashes
+
+    cert_decoded = x509.load_der_x509_certificate(der)
+    return {
+        "fingerprint": cert_decoded.fingerprint(hashes.SHA256()).hex(),
+        # Timezone-aware, e.g. 2030-01-01T00:00:00+00:00
+        "not_valid_after": cert_decoded.not_valid_after_utc.isoformat(),
+        "fetched_at": time.time(),
+    }
+
+
+def _fetch_certificate(client, config):
+    connect_client(client, config)
+    with client:
+        if not config.ssl:
+            # starttls can be called, because mode certificate use either --ssl or --start-tls as options
+            client.starttls()
+        return _describe_certificate(client.sock.getpeercert(binary_form=True))
+
+
+def _certificate_cache_path(utils, config):
+    import hashlib
+
+    key = f"{config.hostaddress}:{config.port}:{'ssl' if config.ssl else 'starttls'}"
+    cache_dir = config.cache_dir or utils.cache_dir("smtp-certificates")
+    return os.path.join(cache_dir, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+
+def _cached_certificate(utils, config):
+    """Returns the cached certificate if the cache is enabled and the certificate not older than --cache-ttl"""
+    from datetime import datetime
+
+    cache_path = _certificate_cache_path(utils, config) if config.cache_ttl > 0 else None
+    cached = utils.read_cache(cache_path) if cache_path and not config.refresh else None
+    if not cached:
+        return None
+    # An entry written by another version, with a naive expiry time, or damaged is fetched again
+    try:
+        aware = datetime.fromisoformat(cached["not_valid_after"]).tzinfo is not None
+        fresh = 0 <= time.time() - cached["fetched_at"] < config.cache_ttl
+    except (KeyError, TypeError, ValueError):
+        return None
+    return cached if aware and fresh else None
+
+
+def _store_certificate(utils, debug, config, certificate):
+    if config.cache_ttl > 0:
+        try:
+            utils.write_cache(_certificate_cache_path(utils, config), certificate)
+        except OSError as err:
+            if debug:
+                print(f"Could not write certificate cache: {err}")
+
+
+def _certificate_result(utils, config, client, certificate, cached):
+    from datetime import datetime
+
+    # The expiry is always evaluated against the current time, even for cached certificates
+    state, days = evaluate_expiry(utils, config, datetime.fromisoformat(certificate["not_valid_after"]))
+    datasets = [utils.build_dataset(name="Certificate validity", value=days)]
+    if cached:
+        datasets.append(
+            utils.build_dataset(name="Certificate age", value=round(time.time() - certificate["fetched_at"]))
+        )
+    return build_phase_result(
+        utils, config, client,
+        state=state,
+        output=f"Certificate is valid {days} days",
+        datasets=datasets
+    )
+
+
+def mode_certificate(utils, debug, argv):
     parser = argparse.ArgumentParser()
-    add_common_args(parser)
+    add_common_args(parser, multiple_targets=True)
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument(
         "--start-tls",
@@ -254,71 +666,264 @@ def mode_certificate(utils, debug):
         dest="ssl",
         help="Specify if SMTPS should be used"
     )
+    add_expiry_args(parser)
     parser.add_argument(
-        "--warning-expiry",
+        "--cache-ttl",
         action="store",
-        dest="warning_expiry",
-        default=20,
+        dest="cache_ttl",
+        default=0,
         type=int,
-        help="Warning threshold (default: %(default)s)"
+        help="Seconds the certificate is answered from the cache without connecting. \
+              Disabled with 0 (default: %(default)s)"
     )
     parser.add_argument(
-        "--critical-expiry",
+        "--cache-dir",
         action="store",
-        dest="critical_expiry",
-        default=10,
-        type=int,
-        help="Critical threshold (default: %(default)s)"
+        dest="cache_dir",
+        help="Directory of the certificate cache. (default: smtp-certificates in the cache directory of utils)"
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        dest="refresh",
+        help="Specify to fetch the certificate even if the cached one is not expired"
+    )
+    config = parser.parse_known_args(argv)[0]
+    targets = parse_targets(parser, config)
+    if len(targets) > 1 or config.targets_file:
+        return probe_targets(utils, debug, config, "certificate", targets)
+
+    client = None
+    certificate = _cached_certificate(utils, config)
+    if not certificate:
+        import smtplib
+        import socket
+
+        client = open_client(utils, config)
+        try:
+            certificate = _fetch_certificate(client, config)
+        except socket.timeout:
+            return build_phase_result(
+                utils, config, client,
+                state=utils.OutputState.UNKNOWN, output=f"Connection to {config.hostaddress} timed out"
+            )
+        except (smtplib.SMTPException, OSError) as err:
+            return build_phase_result(
+                utils, config, client,
+                state=utils.OutputState.CRITICAL, output=f"Connection to {config.hostaddress} failed: {err}"
+            )
+        _store_certificate(utils, debug, config, certificate)
+    if debug:
+        print(certificate)
+    return _certificate_result(utils, config, client, certificate, cached=client is None)
+
+
+def mode_full(utils, debug, argv):
+    import smtplib
+    import socket
+
+    parser = argparse.ArgumentParser()
+    add_common_args(parser)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--start-tls",
+        action="store_true",
+        dest="start_tls",
+        help="Specify if STARTTLS should be used"
+    )
+    group.add_argument(
+        "--ssl",
+        action="store_true",
+        dest="ssl",
+        help="Specify if SMTPS should be used"
+    )
+    parser.add_argument(
+        "--smtp-user",
+        action="store",
+        dest="smtp_user",
+        help="Username to authenticate with. Authentication is skipped if not set"
+    )
+    parser.add_argument(
+        "--smtp-password",
+        action="store",
+        dest="smtp_password",
+        help="Password to authenticate with"
     )
-    config = parser.parse_known_args()[0]
+    add_expiry_args(parser)
+    config = parser.parse_known_args(argv)[0]
+
+    states = []
+    outputs = []
+    datasets = []
+
+    def report(state, output):
+        states.append(state)
+        outputs.append(output)
+
+    start = time.monotonic()
+    client = open_client(utils, config)
     try:
-        if config.ssl:
-            with smtplib.SMTP_SSL(host=config.hostaddress, port=config.port, timeout=config.timeout) as client:
-                cert_decoded = x509.load_der_x509_certificate(client.sock.getpeercert(binary_form=True))
-        else:
-            with smtplib.SMTP(host=config.hostaddress, port=config.port, timeout=config.timeout) as client:
-                # starttls can be called, because mode certificate use either --ssl or --start-tls as options
-                client.starttls()
+        with client:
+            code, msg = client.connect(config.hostaddress, config.port)
+            datasets.append(utils.build_dataset(name="Banner code", value=code))
+            if code != 220:
+                report(utils.OutputState.CRITICAL, f"Banner was {code} {msg.decode(errors='replace')}")
+            code, msg = client.ehlo()
+            datasets.append(utils.build_dataset(name="EHLO code", value=code))
+            if code != 250:
+                report(utils.OutputState.CRITICAL, f"EHLO was answered with {code} {msg.decode(errors='replace')}")
+
+            tls = config.ssl
+            if config.start_tls:
+                if client.has_extn("starttls"):
+                    code, msg = client.starttls()
+                    datasets.append(utils.build_dataset(name="STARTTLS code", value=code))
+                    tls = True
+                else:
+                    report(utils.OutputState.CRITICAL, "STARTTLS is not offered")
+
+            if tls:
+                from cryptography import x509
                 cert_decoded = x509.load_der_x509_certificate(client.sock.getpeercert(binary_form=True))
-    except socket.timeout:
-        utils.build_output(state=utils.OutputState.UNKNOWN, output=f"Connection to {config.hostaddress} timed out")
-    now = datetime.utcnow()
-    critical = now + timedelta(days=config.critical_expiry)
-    critical_due = cert_decoded.not_valid_after - critical
-    if critical_due.total_seconds() <= 0:
-        utils.build_output(
-            state=utils.OutputState.CRITICAL,
-            output=f"Certificate is valid {(cert_decoded.not_valid_after - now).days} days"
+                state, days = evaluate_expiry(utils, config, cert_decoded.not_valid_after_utc)
+                datasets.append(utils.build_dataset(name="Certificate validity", value=days))
+                report(state, f"Certificate is valid {days} days")
+
+            if config.smtp_user:
+                try:
+                    code, msg = client.login(config.smtp_user, config.smtp_password or "")
+                    report(utils.OutputState.OK, "Authentication successful")
+                except smtplib.SMTPAuthenticationError as err:
+                    code = err.smtp_code
+                    report(utils.OutputState.CRITICAL, "Authentication failed")
+                except smtplib.SMTPNotSupportedError:
+                    code = None
+                    report(utils.OutputState.CRITICAL, "Authentication is not supported")
+                if code is not None:
+                    datasets.append(utils.build_dataset(name="AUTH code", value=code))
+    except (smtplib.SMTPServerDisconnected, socket.timeout):
+        return build_phase_result(
+            utils, config, client,
+            state=utils.OutputState.UNKNOWN, output=f"Connection to {config.hostaddress} timed out",
+            datasets=datasets
         )
-    warning = now + timedelta(days=config.warning_expiry)
-    warning_due = cert_decoded.not_valid_after - warning
-    if warning_due.total_seconds() <= 0:
-        utils.build_output(
-            state=utils.OutputState.WARN,
-            output=f"Certificate is valid {(cert_decoded.not_valid_after - now).days} days"
+    except (smtplib.SMTPException, OSError) as err:
+        return build_phase_result(
+            utils, config, client,
+            state=utils.OutputState.CRITICAL, output=f"Connection to {config.hostaddress} failed: {err}",
+            datasets=datasets
         )
-    utils.build_output(
-        state=utils.OutputState.OK,
-        output=f"Certificate is valid {(cert_decoded.not_valid_after - now).days} days"
+    datasets.append(utils.build_dataset(name="Connection time", value=round(time.monotonic() - start, 3)))
+
+    outputs.insert(0, f"Connection to {config.hostaddress} established")
+    return build_phase_result(
+        utils, config, client,
+        state=utils.worst_state(states),
+        output=", ".join(outputs),
+        datasets=datasets
+    )
+
+
+def join_target(host, port):
+    return f"[{host}]:{port}" if ":" in host else f"{host}:{port}"
+
+
+def _evaluate_probe(utils, config, mode, probe):
+    """Evaluates a result of the asyncio engine like the smtplib based modes evaluate a connection"""
+    datasets = [utils.build_dataset(name="Connection time", value=round(probe.duration, 3))]
+    if probe.timed_out:
+        state, output = utils.OutputState.UNKNOWN, "Connection timed out"
+    elif probe.error:
+        state, output = utils.OutputState.CRITICAL, f"Connection failed: {probe.error}"
+    elif mode == "connect":
+        if probe.noop == (250, b'2.0.0 Ok'):
+            state, output = utils.OutputState.OK, "Connection established"
+        else:
+            state, output = utils.OutputState.CRITICAL, f"Connection established, but response was {probe.noop}"
+    elif probe.auth == (235, b'2.7.0 Authentication successful'):
+        state, output = utils.OutputState.OK, "Authentication successful"
+    elif probe.auth[0] == 535:
+        state, output = utils.OutputState.CRITICAL, "Authentication failed"
+    else:
+        state, output = utils.OutputState.UNKNOWN, f"Unexpected response {probe.auth}"
+    return build_phase_result(utils, config, probe, state=state, output=output, datasets=datasets)
+
+
+def probe_targets(utils, debug, config, mode, targets):
+    """This method is used to check many targets concurrently with the asyncio engine of utils
+
+    Every target is evaluated like a single target of the mode. The output has a line per target,
+    datasets are prefixed with the target and the state is the worst state of all targets.
+
+    :param mode: connect, login or certificate
+    :param targets: List of tuples of host and port
+    """
+    asyncsmtp = importlib.import_module(".asyncsmtp", utils.__name__)
+
+    target_configs = []
+    for host, port in targets:
+        target_config = copy.copy(config)
+        target_config.hostaddress, target_config.port = host, port
+        target_configs.append(target_config)
+    certificates = {}
+    if mode == "certificate":
+        certificates = {i: _cached_certificate(utils, x) for i, x in enumerate(target_configs)}
+    pending = [i for i in range(len(targets)) if not certificates.get(i)]
+    probes = dict(zip(pending, asyncsmtp.probe_many(
+        [targets[i] for i in pending],
+        config.concurrency,
+        timeout=config.timeout,
+        use_ssl=config.ssl,
+        starttls=config.start_tls,
+        credentials=(config.smtp_user, config.smtp_password) if mode == "login" else None,
+        noop=mode == "connect",
+    )))
+
+    states = []
+    lines = []
+    datasets = []
+    for index, target_config in enumerate(target_configs):
+        probe = probes.get(index)
+        if debug:
+            print(probe or certificates[index])
+        if mode != "certificate" or (probe and (probe.error or probe.certificate is None)):
+            result = _evaluate_probe(utils, target_config, mode, probe)
+        else:
+            if probe:
+                certificates[index] = _describe_certificate(probe.certificate)
+                _store_certificate(utils, debug, target_config, certificates[index])
+            result = _certificate_result(utils, target_config, probe, certificates[index], cached=probe is None)
+        target = join_target(*targets[index])
+        states.append(result.state)
+        lines.append(f"{target}: {result.output}")
+        datasets.extend({**x, "name": f"{target}/{x['name']}"} for x in result.datasets)
+
+    ok_count = states.count(utils.OutputState.OK)
+    return utils.build_result(
+        state=utils.worst_state(states),
+        output="\n".join([f"{ok_count}/{len(targets)} targets OK", *lines]),
+        datasets=datasets
     )
 
 
-def execute(utils, debug=False):
+def execute(utils, debug=False, argv=None):
     parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument(
         "--mode",
-        choices=["connect", "login", "sendmail", "certificate"],
+        choices=["connect", "login", "sendmail", "certificate", "full"],
         action="store",
         dest="mode",
         required=True,
         help="Set mode the plugin should execute"
     )
-    config = parser.parse_known_args()[0]
+    config = parser.parse_known_args(argv)[0]
     if config.mode == "connect":
-        mode_connect(utils, debug)
+        return mode_connect(utils, debug, argv)
     elif config.mode == "login":
-        mode_connect(utils, debug)
+        return mode_login(utils, debug, argv)
     elif config.mode == "sendmail":
-        mode_sendmail(utils, debug)
+        return mode_sendmail(utils, debug, argv)
     elif config.mode == "certificate":
-        mode_certificate(utils, debug)
+        return mode_certificate(utils, debug, argv)
+    elif config.mode == "full":
+        return mode_full(utils, debug, argv)
@@ -1,13 +1,159 @@
 import argparse
+import os
+import re
+import selectors
 import shlex
+import signal
 import subprocess
+import time
 
 __help__ = """This is a wrapper around nagios plugins.
 It formats the output as well as includes the nagios return code as parsed status code."""
 __requirements__ = []
 
+# Performance data as specified by the nagios plugin development guidelines:
+# 'label'=value[UOM];[warn];[crit];[min];[max]
+_PERFDATA = re.compile(
+    r"""(?:'(?P<quoted>(?:[^']|'')+)'|(?P<label>[^\s'=][^\s=]*))="""
+    r"""(?P<value>U|[-+]?(?:\d+(?:[.,]\d*)?|[.,]\d+)(?:[eE][-+]?\d+)?)(?P<unit>[^;\s]*)"""
+    r"""(?:;(?P<warning>[^;\s]*))?(?:;(?P<critical>[^;\s]*))?(?:;(?P<min>[^;\s]*))?(?:;(?P<max>[^;\s]*))?"""
+)
 
-def execute(utils, debug=False):
+
+def _number(value):
+    if value is None or value == "" or value == "U":
+        return None
+    value = value.replace(",", ".")
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    # Third party plugins may print anything in min and max, like a=1;;;abc;
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def parse_perfdata(perfdata):
+    """This method is used to parse the performance data of a nagios plugin
+
+    :param perfdata: Performance data, multiple lines are joined by whitespace
+    :return: List of dicts with label, value, unit, warning, critical, min and max
+    """
+    parsed = []
+    for match in _PERFDATA.finditer(perfdata):
+        quoted, label, value, unit, warning, critical, minimum, maximum = match.groups()
+        parsed.append({
+            "label": quoted.replace("''", "'") if quoted is not None else label,
+            # U marks a value that could not be determined
+            "value": _number(value),
+            "unit": unit or None,
+            # Thresholds are kept as strings, as they may be ranges like @10:20
+            "warning": warning or None,
+            "critical": critical or None,
+            "min": _number(minimum),
+            "max": _number(maximum),
+        })
+    return parsed
+
+
+def parse_output(stdout):
+    """This method is used to split the output of a nagios plugin into text and performance data
+
+    The first line contains the text and optional performance data separated by |.
+    It is followed by long text lines, the first one containing a | starts the performance data again,
+    which continues until the end of the output.
+
+    :param stdout: Output of the nagios plugin
+    :return: Tuple of text and list of performance data, see parse_perfdata
+    """
+    lines = stdout.splitlines()
+    if not lines:
+        return "", []
+    text, _, perfdata = lines[0].partition("|")
+    text_lines = [text.strip()]
+    perfdata_lines = [perfdata]
+    for index in range(1, len(lines)):
+        long_text, separator, perfdata = lines[index].partition("|")
+        text_lines.append(long_text.rstrip())
+        if separator:
+            perfdata_lines.append(perfdata)
+            perfdata_lines.extend(lines[index + 1:])
+            break
+    return "\n".join(text_lines).strip(), parse_perfdata(" ".join(perfdata_lines))
+
+
+def _kill_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def run_command(command, timeout, max_output):
+    """This method is used to execute a command in its own process group with a hard timeout
+
+    stdout and stderr are read incrementally and everything exceeding max_output bytes is discarded.
+    If the timeout is exceeded, the whole process group is killed.
+
+    :param command: List of program and arguments
+    :param timeout: Timeout in seconds
+    :param max_output: Maximum number of bytes kept of stdout and stderr each
+    :return: dict with stdout, stderr, returncode, timed_out, truncated, elapsed and rusage
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    process = subprocess.Popen(
+        command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True
+    )
+    buffers = {process.stdout: bytearray(), process.stderr: bytearray()}
+    truncated = False
+    with selectors.DefaultSelector() as selector:
+        for stream in buffers:
+            selector.register(stream, selectors.EVENT_READ)
+        while selector.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            for key, _ in selector.select(remaining):
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                    continue
+                # Keep reading beyond the limit, so the command doesn't block on a full pipe
+                buffer = buffers[key.fileobj]
+                space = max(max_output - len(buffer), 0)
+                truncated = truncated or len(chunk) > space
+                buffer += chunk[:space]
+        pipes_open = bool(selector.get_map())
+
+    # The pipes may be closed while the command is still running
+    pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+    while not pid and time.monotonic() < deadline:
+        time.sleep(0.01)
+        pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+    timed_out = not pid
+    if timed_out or pipes_open:
+        # Kill the command or the background processes it left behind holding the pipes
+        _kill_group(process.pid)
+    if timed_out:
+        _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    process.stdout.close()
+    process.stderr.close()
+    return {
+        "stdout": bytes(buffers[process.stdout]),
+        "stderr": bytes(buffers[process.stderr]),
+        "returncode": process.returncode,
+        "timed_out": timed_out,
+        "truncated": truncated,
+        "elapsed": time.monotonic() - start,
+        "rusage": rusage,
+    }
+
+
+def execute(utils, debug=False, argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--command",
@@ -25,26 +171,49 @@ def execute(utils, debug=False):
         default=15,
         help="Timeout in seconds. Defaults to %(default)s"
     )
-    config = parser.parse_known_args()[0]
+    parser.add_argument(
+        "--max-output",
+        action="store",
+        type=int,
+        dest="max_output",
+        default=1024 * 1024,
+        help="Maximum number of bytes read from stdout and stderr each. Defaults to %(default)s"
+    )
+    config = parser.parse_known_args(argv)[0]
     split_cmd = shlex.split(config.command)
-    process = subprocess.Popen(split_cmd, stdout=subprocess.PIPE)
-    stdout, _ = process.communicate(timeout=config.timeout)
-
-    datasets = []
-    split_out = stdout.decode("utf-8").split("|")
-    text = split_out[0].strip()
-    data = split_out[1].strip().split()
-    for d in data:
-        datasets.append(
-            utils.build_dataset(
-                name=d.split("'")[1],
-                value=d.split("=")[1].split(";")[0]
-            )
+    process = run_command(split_cmd, config.timeout, config.max_output)
+    if debug:
+        print(process)
+
+    if process["timed_out"]:
+        rusage = process["rusage"]
+        return utils.build_result(
+            state=utils.OutputState.UNKNOWN,
+            output=f"Command timed out after {process['elapsed']:.1f} seconds",
+            datasets=[
+                utils.build_dataset(name="Execution time", value=round(process["elapsed"], 3), unit="s"),
+                utils.build_dataset(name="CPU user time", value=round(rusage.ru_utime, 3), unit="s"),
+                utils.build_dataset(name="CPU system time", value=round(rusage.ru_stime, 3), unit="s"),
+                # ru_maxrss is reported in kilobytes on linux
+                utils.build_dataset(name="Max RSS", value=rusage.ru_maxrss, unit="KB"),
+            ]
         )
 
-    state = utils.OutputState.OK if process.returncode == 0 else utils.OutputState.WARN if process.returncode == 1 \
-        else utils.OutputState.CRITICAL if process.returncode == 2 else utils.OutputState.UNKNOWN
-    utils.build_output(
+    stdout = process["stdout"] or process["stderr"]
+    text, perfdata = parse_output(stdout.decode("utf-8", errors="replace"))
+    if process["truncated"]:
+        text = f"{text}\n(output truncated)"
+    datasets = [
+        utils.build_dataset(
+            name=x["label"], value=x["value"], unit=x["unit"], warning=x["warning"], critical=x["critical"],
+            minimum=x["min"], maximum=x["max"]
+        ) for x in perfdata
+    ]
+
+    returncode = process["returncode"]
+    state = utils.OutputState.OK if returncode == 0 else utils.OutputState.WARN if returncode == 1 \
+        else utils.OutputState.CRITICAL if returncode == 2 else utils.OutputState.UNKNOWN
+    return utils.build_result(
         state=state,
         output=text,
         datasets=datasets
@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
-import argparse
-import importlib
-import os
-import re
-import traceback
-from collections import ChainMap
+import time
+
+# Taken before anything else is imported, so --startup-report can separate the interpreter from the launcher
+_STARTED = time.perf_counter()
+
+import argparse  # noqa: E402
+import contextlib  # noqa: E402
+import importlib  # noqa: E402
+import os  # noqa: E402
+import sys  # noqa: E402
 
 
 def _check_plugin(plugin):
@@ -16,43 +20,56 @@ def _check_plugin(plugin):
         raise AttributeError("Parameter __help__ is missing")
 
 
-def _traverse_plugin_tree():
+def _traverse_plugin_tree(plugin_root=None, cache_path=None):
+    from launcher import manifest
     plugin_dir = os.path.dirname(os.path.abspath(__file__))
-    plugin_list = {}
-    for dir_path, dir_names, files in os.walk(os.path.join(plugin_dir, "plugins")):
-        for file in files:
-            if file != "__init__.py" and file.endswith("py"):
-                import_path = os.path.relpath(
-                    os.path.join(
-                        dir_path, file[:-3]
-                    ),
-                    os.path.join(
-                        plugin_dir, "plugins"
-                    )
-                ).replace("/", ".")
-                try:
-                    imported = importlib.import_module(f"plugins.{import_path}")
-                except ModuleNotFoundError:
-                    continue
-                try:
-                    _check_plugin(imported)
-                    plugin_list[import_path] = imported
-                except AttributeError:
-                    continue
-    return plugin_list
+    if cache_path is None:
+        cache_path = os.environ.get("Q_PLUGINS_MANIFEST", os.path.join(plugin_dir, ".plugin_manifest.json"))
+    return manifest.load_manifest(plugin_root or os.path.join(plugin_dir, "plugins"), cache_path)
 
 
 def list_plugins(config):
     print("The following plugins are registered:\n")
     for path, plugin in _traverse_plugin_tree().items():
-        help_formatted = "".join([f"\t{x}\n" for x in plugin.__help__.split("\n")])
+        help_formatted = "".join([f"\t{x}\n" for x in plugin["help"].split("\n")])
         print(f"{path}:\n{help_formatted.rstrip()}")
     exit(0)
 
 
 def execute_plugin(config):
-    pattern = re.compile(r"^(\w+\.)*\w+$")
-    if not pattern.fullmatch(config.plugin):
+    report = None
+    if config.startup_report:
+        from launcher import startup
+        report = startup.StartupReport(_STARTED)
+    try:
+        _execute_plugin(config, report)
+    finally:
+        if report:
+            report.print()
+
+
+def _instrumented_execute(config, imported, utils, report):
+    usage = None
+    with contextlib.ExitStack() as stack:
+        if report:
+            stack.callback(report.mark, "execute")
+            stack.enter_context(report.measure_argparse())
+        if config.profile or config.resource_usage:
+            from launcher import profiling
+            if config.profile:
+                output = config.profile_output or profiling.default_output(config.plugin)
+                stack.enter_context(profiling.profile(config.profile, output))
+            if config.resource_usage:
+                usage = stack.enter_context(profiling.ResourceUsage())
+        result = imported.execute(utils, config.debug)
+    if usage and isinstance(result, utils.CheckResult):
+        result.datasets.extend(usage.datasets(utils))
+    return result
+
+
+def _execute_plugin(config, report):
+    # Checked without re, which is not needed by the launcher otherwise
+    if not all(x.isidentifier() for x in config.plugin.split(".")):
         print("Plugin descriptor is not valid.")
         exit(3)
     try:
@@ -65,15 +82,26 @@ def execute_plugin(config):
     except AttributeError:
         print("Plugin is missing required attributes or functions")
         exit(3)
+    if report:
+        report.mark("plugin import")
     utils = importlib.import_module("utils")
+    try:
+        utils.set_output_format(config.output_format, tags={"plugin": config.plugin})
+    except ValueError as err:
+        print(err)
+        exit(3)
+    if report:
+        report.mark("utils import")
     try:
         try:
-            imported.execute(utils, config.debug)
+            result = _instrumented_execute(config, imported, utils, report)
         except ModuleNotFoundError:
             print("There are missing dependencies for this module. The module lists the following dependencies:")
             print("".join([f"\t- {x}\n" for x in imported.__requirements__]).rstrip())
             exit(3)
     except Exception as err:
+        import traceback
+
         if config.debug:
             print("".join(traceback.format_tb(err.__traceback__)), type(err))
         else:
@@ -81,35 +109,150 @@ def execute_plugin(config):
                 state=utils.OutputState.UNKNOWN,
                 output="".join(traceback.format_tb(err.__traceback__))
             )
+    else:
+        # Plugins may print their output on their own instead of returning a result
+        if isinstance(result, utils.CheckResult):
+            utils.print_result(result)
+
+
+def _strip_socket_argument(argv):
+    stripped = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == "--socket":
+            skip = True
+        elif not arg.startswith("--socket="):
+            stripped.append(arg)
+    return stripped
+
+
+def forward_plugin(config, argv):
+    from launcher import server
+    argv = _strip_socket_argument(argv)
+    if not config.output_format and os.environ.get("Q_PLUGINS_OUTPUT_FORMAT"):
+        # The environment of the server is not the one of this process
+        argv.extend(["--output-format", os.environ["Q_PLUGINS_OUTPUT_FORMAT"]])
+    try:
+        exit(server.forward(config.socket, argv, config.check_timeout))
+    except (FileNotFoundError, ConnectionRefusedError):
+        # The server is not running, so the check is executed in this process instead
+        execute_plugin(config)
+    except server.CheckAborted as err:
+        # Reported like any other result, so the caller can parse it in the format it asked for
+        utils = importlib.import_module("utils")
+        try:
+            utils.set_output_format(config.output_format, tags={"plugin": config.plugin})
+        except ValueError as err:
+            print(err)
+            exit(3)
+        utils.build_output(state=utils.OutputState.UNKNOWN, output=str(err))
+
+
+def _serve_check(argv):
+    config = _build_parser().parse_known_args(argv)[0]
+    if not config.plugin:
+        print("Only --plugin can be executed by the server")
+        exit(3)
+    config.socket = None
+    main(config)
+
+
+def serve(config):
+    from launcher import server
+    # Import everything up front, so forked workers don't have to
+    importlib.import_module("utils")
+    for path, plugin in _traverse_plugin_tree().items():
+        for module in [*plugin["requirements"], f"plugins.{path}"]:
+            try:
+                importlib.import_module(module)
+            except ImportError:
+                continue
+    server.serve(config.serve, _serve_check, config.check_timeout)
+    exit(0)
+
+
+def batch(config):
+    from launcher import batch
+    if config.batch == "-":
+        batch.run_batch(sys.stdin, config.batch_workers, config.batch_timeout)
+    else:
+        with open(config.batch) as fh:
+            batch.run_batch(fh, config.batch_workers, config.batch_timeout)
+    exit(0)
+
+
+def exporter(config):
+    from launcher import exporter, scheduler
+    try:
+        checks, limits = scheduler.load_config(config.exporter)
+        listen = exporter.parse_listen(config.listen)
+    except (OSError, ValueError) as err:
+        print(f"Invalid exporter config: {err}")
+        exit(3)
+    exporter.serve(checks, listen, config.workers, limits)
+    exit(0)
+
+
+def schedule(config):
+    import signal
+    from launcher import scheduler
+    try:
+        checks, limits = scheduler.load_config(config.schedule)
+        sink = scheduler.open_sink(config.sink)
+    except (OSError, ValueError) as err:
+        print(f"Invalid scheduler config: {err}")
+        exit(3)
+    check_scheduler = scheduler.Scheduler(checks, config.workers, sink, limits, config.stats_interval)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        check_scheduler.run()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        check_scheduler.stop()
+    exit(0)
 
 
 def install_requirements(config):
-    requirement_list = []
+    from launcher import requirements
     all_plugins = _traverse_plugin_tree()
-    search_plugins = all_plugins if not config.install_requirements else dict(ChainMap(*[
-        {x: all_plugins[x]} for x in all_plugins if x in config.install_requirements
-    ]))
-    for plugin in search_plugins.values():
-        for requirement in plugin.__requirements__:
-            if requirement not in requirement_list:
-                requirement_list.append(requirement)
+    search_plugins = all_plugins if not config.install_requirements else {
+        x: all_plugins[x] for x in all_plugins if x in config.install_requirements
+    }
+    requirement_list = list(dict.fromkeys(
+        requirement for plugin in search_plugins.values() for requirement in plugin["requirements"]
+    ))
     if not requirement_list:
         print("There are no requirements listed")
         exit(0)
-    os.system(f"/usr/bin/env python3 -m pip install -U {' '.join(requirement_list)} {'--user' if config.user else ''}")
-    exit(0)
+    if config.build_wheelhouse:
+        exit(requirements.build_wheelhouse(requirement_list, config.build_wheelhouse))
+    exit(requirements.install(requirement_list, config.wheelhouse, config.user))
 
 
-def main(config):
+def main(config, argv=None):
     if config.list_plugins:
         list_plugins(config)
+    if config.serve:
+        serve(config)
+    if config.batch:
+        batch(config)
+    if config.exporter:
+        exporter(config)
+    if config.schedule:
+        schedule(config)
     if config.plugin:
-        execute_plugin(config)
+        if config.socket:
+            forward_plugin(config, argv if argv is not None else sys.argv[1:])
+        else:
+            execute_plugin(config)
     if config.install_requirements is not None:
         install_requirements(config)
 
 
-if __name__ == '__main__':
+def _build_parser():
     parser = argparse.ArgumentParser(add_help=False)
     first_level_group = parser.add_mutually_exclusive_group(required=True)
     first_level_group.add_argument(
@@ -131,16 +274,162 @@ if __name__ == '__main__':
         help="List plugins to install the requirements for. \
               If None are listed, requirements for all plugins are installed"
     )
+    first_level_group.add_argument(
+        "--serve",
+        action="store",
+        dest="serve",
+        metavar="SOCKET",
+        help="Keep a warm process serving check requests on the given unix socket"
+    )
+    first_level_group.add_argument(
+        "--batch",
+        action="store",
+        dest="batch",
+        metavar="FILE",
+        help="Execute the checks of a JSONL file concurrently, use - to read from stdin"
+    )
+    first_level_group.add_argument(
+        "--exporter",
+        action="store",
+        dest="exporter",
+        metavar="CONFIG",
+        help="Refresh the checks of a json config in the background and serve their results as OpenMetrics"
+    )
+    parser.add_argument(
+        "--listen",
+        action="store",
+        dest="listen",
+        default="127.0.0.1:9690",
+        metavar="HOST:PORT",
+        help="Address --exporter listens on, enclose IPv6 addresses in brackets. (default: %(default)s)"
+    )
+    first_level_group.add_argument(
+        "--schedule",
+        action="store",
+        dest="schedule",
+        metavar="CONFIG",
+        help="Run the checks of a json config on their intervals and write the results to --sink"
+    )
+    parser.add_argument(
+        "--sink",
+        action="store",
+        dest="sink",
+        default="stdout",
+        help="Where --schedule writes results and stats: stdout, file:PATH or module:callable. \
+              (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--stats-interval",
+        action="store",
+        dest="stats_interval",
+        type=float,
+        default=60,
+        help="Seconds between the stats records of --schedule. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--workers",
+        action="store",
+        dest="workers",
+        type=int,
+        default=16,
+        help="Maximum number of checks --schedule and --exporter execute at the same time. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--batch-workers",
+        action="store",
+        dest="batch_workers",
+        type=int,
+        default=16,
+        help="Maximum number of checks --batch executes at the same time. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--batch-timeout",
+        action="store",
+        dest="batch_timeout",
+        type=float,
+        default=30,
+        help="Timeout in seconds for checks without a timeout in their spec. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--socket",
+        action="store",
+        dest="socket",
+        help="Execute --plugin on the server listening on the given unix socket. \
+              Falls back to local execution if the server is not reachable"
+    )
+    parser.add_argument(
+        "--check-timeout",
+        action="store",
+        dest="check_timeout",
+        type=float,
+        default=60,
+        help="Seconds a check may run on the server of --serve before it is killed \
+              and --socket waits for its result. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--build-wheelhouse",
+        action="store",
+        dest="build_wheelhouse",
+        metavar="DIR",
+        help="Build wheels of the requirements selected by --install-requirements into DIR instead of installing them"
+    )
+    parser.add_argument(
+        "--wheelhouse",
+        action="store",
+        dest="wheelhouse",
+        metavar="DIR",
+        help="Install the requirements selected by --install-requirements from a directory built with \
+              --build-wheelhouse without accessing the package index"
+    )
     parser.add_argument(
         "--install-user",
         action="store_true",
         dest="user",
         help="Specify if you want to install with the --user option with pip"
     )
+    parser.add_argument(
+        "--output-format",
+        action="store",
+        dest="output_format",
+        choices=["json", "compact", "msgpack", "influx"],
+        help="Encoding of the result of --plugin. (default: $Q_PLUGINS_OUTPUT_FORMAT or json)"
+    )
+    parser.add_argument(
+        "--startup-report",
+        action="store_true",
+        dest="startup_report",
+        help="Print where the time of --plugin was spent to stderr: interpreter, launcher, plugin import, \
+              argparse and execute"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store",
+        dest="profile",
+        choices=["cprofile", "tracemalloc", "all"],
+        help="Profile the execution of --plugin and write the stats to --profile-output"
+    )
+    parser.add_argument(
+        "--profile-output",
+        action="store",
+        dest="profile_output",
+        metavar="PREFIX",
+        help="Path prefix of the files written by --profile, .prof and .tracemalloc are appended. \
+              (default: q_plugins-PLUGIN-PID in the temporary directory)"
+    )
+    parser.add_argument(
+        "--resource-usage",
+        action="store_true",
+        dest="resource_usage",
+        help="Add wall time, CPU time, max RSS and peak allocations of --plugin to the datasets of its result"
+    )
     parser.add_argument(
         "--debug",
         action="store_true",
         help="Specify to enable debugging mode; More but not json formatted output will appear"
     )
-    c = parser.parse_known_args()[0]
+    return parser
+
+
+if __name__ == '__main__':
+    c = _build_parser().parse_known_args()[0]
     main(c)
@@ -1 +1,25 @@
+import importlib
+
 from .output import *
+from .cache import *
+
+# Helpers only some plugins use are imported on first access, so every check doesn't pay for
+# the modules they depend on
+_LAZY = {
+    "Spool": "spool", "SpoolEntry": "spool", "build_digest": "spool",
+    "LatencyHistogram": "stats",
+    "Resolution": "resolver", "Resolver": "resolver", "get_resolver": "resolver",
+    "History": "history", "HistoryRecord": "history", "open_history": "history",
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{_LAZY[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
@@ -0,0 +1,259 @@
+import asyncio
+import base64
+import functools
+import socket
+import ssl
+import time
+import typing
+
+from .resolver import Resolver, get_resolver
+
+__all__ = ["SMTPProbeError", "SMTPProbeResult", "probe", "probe_many"]
+
+# Lines longer than this are not valid SMTP, smtplib uses the same limit
+_MAXLINE = 8192
+
+
+class SMTPProbeError(Exception):
+    """Raised if the server answers unexpectedly or closes the connection"""
+
+
+class SMTPProbeResult:
+    """Responses and phase durations of a probe of a single SMTP server
+
+    Responses are tuples of code and message like the return values of smtplib,
+    or None if the probe didn't get that far.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        # Duration of every protocol phase in seconds, named like the phases of the smtp plugin
+        self.phases = {}
+        # Whether the address was answered from the cache of the resolver, None for IP addresses
+        self.dns_cached = None
+        self.banner = None
+        self.ehlo = None
+        self.extensions = {}
+        self.starttls = None
+        self.auth = None
+        self.noop = None
+        # Peer certificate in DER format if TLS was used
+        self.certificate = None
+        self.error = None
+        self.timed_out = False
+        self.duration = 0.0
+
+    def __repr__(self):
+        return f"SMTPProbeResult(host={self.host!r}, port={self.port}, banner={self.banner}, " \
+               f"starttls={self.starttls}, auth={self.auth}, noop={self.noop}, error={self.error!r}, " \
+               f"timed_out={self.timed_out})"
+
+
+@functools.lru_cache(maxsize=None)
+def _local_hostname():
+    # Resolved once instead of for every connection, smtplib uses the same name for EHLO
+    return socket.getfqdn()
+
+
+def _tls_context():
+    # Like smtplib without a context, the certificate is fetched but not verified
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class _Connection:
+    def __init__(self, result: SMTPProbeResult):
+        self.result = result
+        self.reader = None
+        self.writer = None
+
+    async def measure(self, phase, awaitable):
+        start = time.monotonic()
+        try:
+            return await awaitable
+        finally:
+            # Also recorded if the phase is cancelled by the timeout
+            self.result.phases[phase] = self.result.phases.get(phase, 0) + time.monotonic() - start
+
+    async def open(self, addresses):
+        loop = asyncio.get_running_loop()
+        error = None
+        for family, sock_type, proto, _, address in addresses:
+            sock = socket.socket(family, sock_type, proto)
+            sock.setblocking(False)
+            try:
+                await loop.sock_connect(sock, address)
+            except OSError as err:
+                error = err
+                sock.close()
+                continue
+            except BaseException:
+                sock.close()
+                raise
+            self.reader, self.writer = await asyncio.open_connection(sock=sock, limit=_MAXLINE)
+            return
+        raise error or OSError(f"No address found for {self.result.host}")
+
+    async def read_response(self):
+        lines = []
+        while True:
+            try:
+                line = await self.reader.readline()
+            except (asyncio.LimitOverrunError, ValueError):
+                raise SMTPProbeError("Line too long")
+            if not line:
+                raise SMTPProbeError("Connection unexpectedly closed")
+            try:
+                code = int(line[:3])
+            except ValueError:
+                raise SMTPProbeError(f"Invalid response {line!r}")
+            lines.append(line[4:].strip(b" \t\r\n"))
+            if line[3:4] != b"-":
+                return code, b"\n".join(lines)
+
+    async def command(self, line):
+        self.writer.write(f"{line}\r\n".encode("utf-8"))
+        await self.writer.drain()
+        return await self.read_response()
+
+    async def start_tls(self, server_hostname):
+        await self.writer.start_tls(_tls_context(), server_hostname=server_hostname)
+
+    async def hello(self, name):
+        code, msg = await self.command(f"EHLO {name}")
+        self.result.ehlo = (code, msg)
+        self.result.extensions = {}
+        if code != 250:
+            code, msg = await self.command(f"HELO {name}")
+            if code != 250:
+                raise SMTPProbeError(f"HELO was answered with {code} {msg.decode(errors='replace')}")
+            return
+        for line in msg.split(b"\n")[1:]:
+            keyword, _, params = line.decode("utf-8", errors="replace").partition(" ")
+            self.result.extensions[keyword.lower()] = params.strip()
+
+    async def login(self, user, password):
+        mechanisms = self.result.extensions.get("auth", "").upper().split()
+        if "PLAIN" in mechanisms:
+            secret = base64.b64encode(f"\0{user}\0{password}".encode("utf-8")).decode("ascii")
+            return await self.command(f"AUTH PLAIN {secret}")
+        if "LOGIN" in mechanisms:
+            code, msg = await self.command("AUTH LOGIN")
+            for value in (user, password):
+                if code != 334:
+                    break
+                code, msg = await self.command(base64.b64encode(value.encode("utf-8")).decode("ascii"))
+            return code, msg
+        raise SMTPProbeError("Authentication is not supported")
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            # The answer of QUIT is not waited for, it doesn't tell anything about the server
+            self.writer.write(b"QUIT\r\n")
+            self.writer.close()
+            await asyncio.wait_for(self.writer.wait_closed(), 1)
+        except (OSError, asyncio.TimeoutError, ssl.SSLError):
+            pass
+
+
+async def _probe(result, use_ssl, starttls, credentials, noop, local_hostname, resolver):
+    loop = asyncio.get_running_loop()
+    connection = _Connection(result)
+    try:
+        # Lookups the cache can't answer block, so they run in the default executor like loop.getaddrinfo
+        resolution = await connection.measure("dns", loop.run_in_executor(None, resolver.resolve, result.host))
+        result.dns_cached = resolution.cached
+        await connection.measure("tcp", connection.open(resolution.addrinfo(result.port)))
+        if use_ssl:
+            await connection.measure("tls", connection.start_tls(result.host))
+        result.banner = await connection.measure("banner", connection.read_response())
+        if result.banner[0] != 220:
+            raise SMTPProbeError(f"Banner was {result.banner[0]} {result.banner[1].decode(errors='replace')}")
+        await connection.measure("ehlo", connection.hello(local_hostname))
+        if starttls and not use_ssl:
+            if "starttls" not in result.extensions:
+                raise SMTPProbeError("STARTTLS is not offered")
+            result.starttls = await connection.measure("starttls", connection.command("STARTTLS"))
+            if result.starttls[0] != 220:
+                raise SMTPProbeError(f"STARTTLS was answered with {result.starttls[0]}")
+            await connection.measure("starttls", connection.start_tls(result.host))
+            # The state of the session is reset by STARTTLS
+            await connection.measure("ehlo", connection.hello(local_hostname))
+        ssl_object = connection.writer.get_extra_info("ssl_object")
+        if ssl_object is not None:
+            result.certificate = ssl_object.getpeercert(binary_form=True)
+        if credentials:
+            result.auth = await connection.measure("auth", connection.login(*credentials))
+        if noop:
+            result.noop = await connection.command("NOOP")
+    finally:
+        await connection.close()
+
+
+async def probe(host: str, port: int, *, timeout: float = 10, use_ssl: bool = False, starttls: bool = False,
+                credentials: typing.Optional[typing.Tuple[str, str]] = None, noop: bool = True,
+                local_hostname: typing.Optional[str] = None,
+                resolver: typing.Optional[Resolver] = None) -> SMTPProbeResult:
+    """This method is used to probe a SMTP server
+
+    Errors don't raise, they are stored in the result together with the responses received until then.
+
+    :param host: Hostname or IP of the server
+    :param port: Port of the server
+    :param timeout: Seconds the whole probe may take
+    :param use_ssl: Use SMTPS
+    :param starttls: Use STARTTLS, ignored with use_ssl
+    :param credentials: Tuple of user and password to authenticate with AUTH PLAIN or LOGIN
+    :param noop: Send a NOOP after everything else
+    :param local_hostname: Name sent with EHLO. (default: the FQDN of this host)
+    :param resolver: Resolver of hostnames. (default: get_resolver())
+    :return: SMTPProbeResult
+    """
+    result = SMTPProbeResult(host, port)
+    start = time.monotonic()
+    try:
+        await asyncio.wait_for(
+            _probe(
+                result, use_ssl, starttls, credentials, noop, local_hostname or _local_hostname(),
+                resolver or get_resolver()
+            ),
+            timeout
+        )
+    except asyncio.TimeoutError:
+        result.timed_out = True
+        result.error = "timed out"
+    except (SMTPProbeError, OSError, UnicodeError) as err:
+        result.error = str(err) or type(err).__name__
+    result.duration = time.monotonic() - start
+    return result
+
+
+def probe_many(targets: typing.Iterable[typing.Tuple[str, int]], concurrency: int = 100,
+               **kwargs) -> typing.List[SMTPProbeResult]:
+    """This method is used to probe many SMTP servers concurrently
+
+    :param targets: Tuples of host and port
+    :param concurrency: Maximum number of open connections
+    :param kwargs: Options of probe
+    :return: List of SMTPProbeResult in the order of the targets
+    """
+    kwargs.setdefault("local_hostname", _local_hostname())
+    kwargs["resolver"] = kwargs.get("resolver") or get_resolver()
+
+    async def run():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited(host, port):
+            async with semaphore:
+                return await probe(host, port, **kwargs)
+        return await asyncio.gather(*(limited(host, port) for host, port in targets))
+
+    try:
+        return asyncio.run(run())
+    finally:
+        kwargs["resolver"].flush()
@@ -0,0 +1,46 @@
+import json
+import os
+import typing
+
+__all__ = ["cache_dir", "read_cache", "write_cache"]
+
+
+def cache_dir(*parts: str) -> str:
+    """This method is used to retrieve a directory for persistent caches of plugins
+
+    The base directory is $Q_PLUGINS_CACHE_DIR or $XDG_CACHE_HOME/q-plugins.
+
+    :param parts: Subdirectories below the base directory
+    :return: Path of the directory, it is created if it doesn't exist
+    """
+    base = os.environ.get("Q_PLUGINS_CACHE_DIR") or os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "q-plugins"
+    )
+    path = os.path.join(base, *parts)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+
+def read_cache(path: str) -> typing.Optional[typing.Any]:
+    """This method is used to read a cache file written with write_cache
+
+    :param path: Path of the cache file
+    :return: The cached data or None if the file is missing or corrupt
+    """
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def write_cache(path: str, data: typing.Any):
+    """This method is used to atomically replace a cache file
+
+    :param path: Path of the cache file
+    :param data: JSON serializable data
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as fh:
+        json.dump(data, fh)
+    os.replace(tmp_path, path)
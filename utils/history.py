@@ -0,0 +1,193 @@
+import fcntl
+import math
+import mmap
+import os
+import struct
+import time
+import typing
+
+from .cache import cache_dir
+from .output import _EXIT_CODES, OutputState
+
+__all__ = ["History", "HistoryRecord", "open_history"]
+
+_MAGIC = b"QPH1"
+# Magic, number of values per record, capacity, length of the encoded names, number of appended records
+_HEADER = struct.Struct("<4sHIIQ")
+# Only the number of appended records changes after the file is created
+_APPENDED = struct.Struct("<Q")
+_APPENDED_OFFSET = _HEADER.size - _APPENDED.size
+_STATES = {code: state for state, code in _EXIT_CODES.items()}
+
+
+class HistoryRecord(typing.NamedTuple):
+    timestamp: float
+    state: OutputState
+    # Values in the order of the names of the history, NaN if a value was missing
+    values: typing.Tuple[float, ...]
+
+
+class History:
+    """Ring buffer of the last results of a check in a memory mapped file
+
+    Every record holds the timestamp, the state and one float per name in a fixed binary layout,
+    so appending only writes a single record and never reads older ones. The file is locked
+    while it is written or read, so concurrent runs of the same check don't corrupt it.
+    The layout of a file never changes once it is created, other processes may have it mapped.
+    open_history uses a file per names and capacity, so a history with another layout starts over.
+    """
+
+    def __init__(self, path: str, names: typing.Sequence[str], capacity: int = 100):
+        """
+        :param path: Path of the history file, created if it doesn't exist
+        :param names: Names of the values of every record
+        :param capacity: Number of records kept
+        :raises ValueError: If capacity is less than 1 or the file has another layout
+        """
+        if capacity < 1:
+            raise ValueError(f"Capacity has to be at least 1, not {capacity}")
+        self.path = path
+        self.names = list(names)
+        self.capacity = capacity
+        self._record = struct.Struct(f"<dB7x{len(self.names)}d")
+        encoded = "\n".join(self.names).encode("utf-8")
+        # Records start 8 byte aligned after the header and the names
+        self._offset = _HEADER.size + len(encoded) + -(_HEADER.size + len(encoded)) % 8
+        size = self._offset + capacity * self._record.size
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            header = _HEADER.pack(_MAGIC, len(self.names), capacity, len(encoded), 0) + encoded
+            # An empty file was just created and can't be mapped by anyone else yet
+            if os.fstat(self._fd).st_size == 0:
+                os.pwrite(self._fd, header, 0)
+                os.ftruncate(self._fd, size)
+            existing = os.pread(self._fd, len(header), 0)
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            if os.fstat(self._fd).st_size != size or len(existing) != len(header) or \
+                    existing[:_APPENDED_OFFSET] != header[:_APPENDED_OFFSET] or \
+                    existing[_HEADER.size:] != encoded:
+                raise ValueError(f"{path} is a history of other values or another capacity")
+            self._map = mmap.mmap(self._fd, size)
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def appended(self) -> int:
+        """Number of records appended since the history was created"""
+        return _APPENDED.unpack_from(self._map, _APPENDED_OFFSET)[0]
+
+    def append(self, state: OutputState, values: typing.Dict[str, float], timestamp: float = None):
+        """This method is used to add a result, the oldest record is overwritten if the history is full
+
+        :param state: State of the result
+        :param values: dict of name to value, names which are not part of the history are ignored
+        :param timestamp: Unix time of the result. (default: now)
+        """
+        record = self._record.pack(
+            time.time() if timestamp is None else timestamp,
+            _EXIT_CODES.get(state, 3),
+            *(float(values.get(name, math.nan)) for name in self.names)
+        )
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            appended = self.appended
+            position = self._offset + appended % self.capacity * self._record.size
+            self._map[position:position + self._record.size] = record
+            _APPENDED.pack_into(self._map, _APPENDED_OFFSET, appended + 1)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def records(self, window: int = None) -> typing.List[HistoryRecord]:
+        """This method is used to read the latest records
+
+        :param window: Maximum number of records. (default: all records)
+        :return: List of HistoryRecord, the oldest first
+        """
+        fcntl.flock(self._fd, fcntl.LOCK_SH)
+        try:
+            appended = self.appended
+            count = min(appended, self.capacity, window or self.capacity)
+            records = []
+            for index in range(appended - count, appended):
+                timestamp, code, *values = self._record.unpack_from(
+                    self._map, self._offset + index % self.capacity * self._record.size
+                )
+                records.append(HistoryRecord(timestamp, _STATES.get(code, OutputState.UNKNOWN), tuple(values)))
+            return records
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _values(self, name, window):
+        index = self.names.index(name)
+        return [(x.timestamp, x.values[index]) for x in self.records(window) if not math.isnan(x.values[index])]
+
+    def flapping(self, window: int = None) -> float:
+        """This method is used to calculate how often the state changed
+
+        Like in Nagios, records missing in a history which isn't full yet count as unchanged,
+        so a new history doesn't flap after its first state change.
+
+        :param window: Number of latest records to consider. (default: all records)
+        :return: Percent of consecutive records with different states
+        """
+        window = min(window or self.capacity, self.capacity)
+        if window < 2:
+            return 0.0
+        states = [x.state for x in self.records(window)]
+        return 100 * sum(1 for a, b in zip(states, states[1:]) if a != b) / (window - 1)
+
+    def moving_average(self, name: str, window: int = None) -> typing.Optional[float]:
+        """This method is used to calculate the average of a value
+
+        :param name: Name of the value
+        :param window: Number of latest records to consider. (default: all records)
+        :return: The average or None if no record has the value
+        """
+        values = [x[1] for x in self._values(name, window)]
+        return sum(values) / len(values) if values else None
+
+    def rate_of_change(self, name: str, window: int = None) -> typing.Optional[float]:
+        """This method is used to calculate the trend of a value as slope of a least squares fit
+
+        :param name: Name of the value
+        :param window: Number of latest records to consider. (default: all records)
+        :return: Change of the value per second or None with less than two records of different time
+        """
+        points = self._values(name, window)
+        if len(points) < 2:
+            return None
+        mean_time = sum(x[0] for x in points) / len(points)
+        mean_value = sum(x[1] for x in points) / len(points)
+        variance = sum((x[0] - mean_time) ** 2 for x in points)
+        if not variance:
+            return None
+        return sum((x[0] - mean_time) * (x[1] - mean_value) for x in points) / variance
+
+
+def open_history(identity: str, names: typing.Sequence[str], capacity: int = 100) -> History:
+    """This method is used to open the history of a check in the cache directory
+
+    :param identity: Unique name of the check, e.g. the plugin with its target
+    :param names: Names of the values of every record
+    :param capacity: Number of records kept
+    :return: History, has to be closed
+    """
+    import hashlib
+
+    # The layout is part of the name, a file is never resized while another process has it mapped
+    layout = hashlib.sha256("\n".join([str(capacity), *names]).encode("utf-8")).hexdigest()[:16]
+    name = f"{hashlib.sha256(identity.encode('utf-8')).hexdigest()}-{layout}.bin"
+    return History(os.path.join(cache_dir("history"), name), names, capacity)
@@ -1,5 +1,8 @@
 import enum
 import json
+import math
+import os
+import sys
 import typing
 
 
@@ -10,16 +13,216 @@ class OutputState(enum.Enum):
     UNKNOWN = "unknown"
 
 
+_EXIT_CODES = {
+    OutputState.OK: 0,
+    OutputState.WARN: 1,
+    OutputState.CRITICAL: 2,
+    OutputState.UNKNOWN: 3,
+}
+
+
+# Order in which states are considered worse than others, following Icinga 2
+_SEVERITY = {
+    OutputState.OK: 0,
+    OutputState.WARN: 1,
+    OutputState.UNKNOWN: 2,
+    OutputState.CRITICAL: 3,
+}
+
+
+def worst_state(states: typing.Iterable[OutputState]) -> OutputState:
+    """This method is used to aggregate multiple states to the worst of them
+
+    :param states: States to aggregate
+    :return: The worst state or OK if states is empty
+    """
+    return max(states, key=lambda x: _SEVERITY[x], default=OutputState.OK)
+
+
+class CheckResult:
+    """Result of a single plugin execution"""
+
+    def __init__(self, *, state: OutputState, output: str, datasets: typing.List[typing.Dict] = None):
+        self.state = state
+        self.output = output
+        self.datasets = list(datasets) if datasets else []
+
+    @property
+    def exit_code(self) -> int:
+        return _EXIT_CODES.get(self.state, 3)
+
+    def to_dict(self) -> typing.Dict:
+        return {
+            "state": self.state.value,
+            "output": self.output,
+            "datasets": self.datasets
+        }
+
+    def __repr__(self):
+        return f"CheckResult(state={self.state}, output={self.output!r}, datasets={self.datasets!r})"
+
+
 def build_dataset(
-    *, name, value
+    *, name, value, unit=None, warning=None, critical=None, minimum=None, maximum=None
 ):
     """This method is used to build a dataset
 
     :param name: Name of the dataset
     :param value: Value of the dataset
+    :param unit: Optional unit of measurement of value
+    :param warning: Optional warning threshold or range
+    :param critical: Optional critical threshold or range
+    :param minimum: Optional minimum possible value
+    :param maximum: Optional maximum possible value
     :return: dict
     """
-    return {"name": name, "value": value}
+    dataset = {"name": name, "value": value}
+    # Optional fields are left out, if not specified
+    for key, optional in (
+        ("unit", unit), ("warning", warning), ("critical", critical), ("min", minimum), ("max", maximum)
+    ):
+        if optional is not None:
+            dataset[key] = optional
+    return dataset
+
+
+def build_result(
+        *, state: OutputState, output: str, datasets: typing.List[typing.Dict] = None
+) -> CheckResult:
+    """This method is used to build the result a plugin returns from execute
+
+    :param state: State the output should have
+    :param output: Output of the check
+    :param datasets: List of datasets built with build_dataset
+    :return: CheckResult
+    """
+    return CheckResult(state=state, output=output, datasets=datasets)
+
+
+OUTPUT_FORMATS = ("json", "compact", "msgpack", "influx")
+
+# Set by the launcher with set_output_format, $Q_PLUGINS_OUTPUT_FORMAT is used otherwise
+_output = {"format": None, "tags": {}}
+
+
+def set_output_format(output_format: str = None, *, tags: typing.Dict[str, str] = None):
+    """This method is used to select how print_result encodes results
+
+    :param output_format: One of OUTPUT_FORMATS, defaults to $Q_PLUGINS_OUTPUT_FORMAT or json
+    :param tags: Tags added to every line of the influx format, e.g. the plugin
+    :raises ValueError: If the format is unknown or the package it requires is not installed
+    """
+    output_format = output_format or os.environ.get("Q_PLUGINS_OUTPUT_FORMAT") or "json"
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format}, use one of {', '.join(OUTPUT_FORMATS)}")
+    if output_format == "msgpack":
+        try:
+            import msgpack  # noqa: F401
+        except ImportError:
+            raise ValueError("Output format msgpack requires the package msgpack")
+    _output["format"] = output_format
+    _output["tags"] = dict(tags or {})
+
+
+def _encode_json(result):
+    return json.dumps(result.to_dict()) + "\n"
+
+
+def _encode_compact(result):
+    try:
+        import orjson
+        return orjson.dumps(result.to_dict()).decode("utf-8") + "\n"
+    except (ImportError, TypeError):
+        # orjson is optional and rejects some values the json module accepts, e.g. non str keys
+        return json.dumps(result.to_dict(), separators=(",", ":"), ensure_ascii=False) + "\n"
+
+
+def _encode_msgpack(result):
+    import msgpack
+    return msgpack.packb(result.to_dict(), use_bin_type=True)
+
+
+def _influx_tag(value):
+    return str(value).replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def _influx_field(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        # Numbers are always written as floats, so a field doesn't change its type between runs
+        return repr(float(value)) if math.isfinite(value) else None
+    escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'"{escaped}"'
+
+
+def _influx_tags(tags):
+    return "".join(f",{_influx_tag(k)}={_influx_tag(v)}" for k, v in sorted(tags.items()) if v not in (None, ""))
+
+
+def _encode_influx(result):
+    import time
+
+    timestamp = time.time_ns()
+    # The tags of the launcher are the same on every line, so they are rendered only once
+    tags = _influx_tags(_output["tags"])
+    lines = [
+        f"q_plugins{tags} state={_influx_field(result.state.value)},exit_code={result.exit_code}i,"
+        f"output={_influx_field(result.output)} {timestamp}\n"
+    ]
+    for dataset in result.datasets:
+        fields = []
+        for key in ("value", "warning", "critical", "min", "max"):
+            value = _influx_field(dataset[key]) if key in dataset else None
+            if value is not None:
+                fields.append(f"{key}={value}")
+        if fields:
+            unit = f",unit={_influx_tag(dataset['unit'])}" if dataset.get("unit") else ""
+            lines.append(
+                f"q_plugins_dataset,dataset={_influx_tag(dataset['name'])}{tags}{unit} {','.join(fields)} {timestamp}\n"
+            )
+    return "".join(lines)
+
+
+_ENCODERS = {
+    "json": _encode_json,
+    "compact": _encode_compact,
+    "msgpack": _encode_msgpack,
+    "influx": _encode_influx,
+}
+
+
+def encode_result(result: CheckResult, output_format: str = None) -> typing.Union[str, bytes]:
+    """This method is used to encode a result in one of OUTPUT_FORMATS
+
+    :param result: Result to encode
+    :param output_format: Format to use, defaults to the one selected with set_output_format
+    :return: str for text formats, bytes for msgpack
+    """
+    if output_format is None:
+        if _output["format"] is None:
+            set_output_format()
+        output_format = _output["format"]
+    return _ENCODERS[output_format](result)
+
+
+def print_result(result: CheckResult):
+    """This method is used to print a result and exit with its exit code
+
+    The result is encoded with the format selected with set_output_format, json by default.
+
+    :param result: Result to print
+    """
+    encoded = encode_result(result)
+    if isinstance(encoded, bytes):
+        sys.stdout.flush()
+        sys.stdout.buffer.write(encoded)
+        sys.stdout.buffer.flush()
+    else:
+        sys.stdout.write(encoded)
+    sys.exit(result.exit_code)
 
 
 def build_output(
@@ -31,18 +234,32 @@ def build_output(
     :param output: Output of the check
     :param datasets:
     """
-    print(json.dumps(
-        {
-            "state": state.value,
-            "output": output,
-            "datasets": datasets if datasets else []
-        }
-    ))
-    if state == OutputState.OK:
-        exit(0)
-    elif state == OutputState.WARN:
-        exit(1)
-    elif state == OutputState.CRITICAL:
-        exit(2)
-    else:
-        exit(3)
+    print_result(build_result(state=state, output=output, datasets=datasets))
+
+
+def invoke_plugin(plugin, argv: typing.List[str], debug: bool = False) -> CheckResult:
+    """This method is used to execute a plugin in the current process without printing or exiting
+
+    :param plugin: Imported plugin module
+    :param argv: Arguments for the plugin
+    :param debug: Enable the debug mode of the plugin
+    :return: CheckResult
+    """
+    try:
+        result = plugin.execute(sys.modules[__package__], debug, list(argv))
+    except SystemExit as err:
+        # Plugins that print their output on their own exit, as do argparse errors
+        return build_result(state=OutputState.UNKNOWN, output=f"Plugin exited with code {err.code}")
+    except ModuleNotFoundError:
+        return build_result(
+            state=OutputState.UNKNOWN,
+            output="There are missing dependencies for this module. The module lists the following dependencies:\n"
+                   + "".join([f"\t- {x}\n" for x in plugin.__requirements__]).rstrip()
+        )
+    except Exception as err:
+        import traceback
+
+        return build_result(state=OutputState.UNKNOWN, output="".join(traceback.format_tb(err.__traceback__)))
+    if not isinstance(result, CheckResult):
+        return build_result(state=OutputState.UNKNOWN, output="Plugin did not return a result")
+    return result
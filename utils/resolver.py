@@ -0,0 +1,195 @@
+import atexit
+import functools
+import os
+import threading
+import time
+import typing
+
+from .cache import cache_dir, read_cache, write_cache
+
+__all__ = ["Resolution", "Resolver", "get_resolver"]
+
+
+class Resolution(typing.NamedTuple):
+    host: str
+    # Tuples of address family and socket address with port 0, like the results of getaddrinfo
+    addresses: typing.List[typing.Tuple[int, tuple]]
+    # True if answered from the cache, False if resolved, None for IP addresses which need no resolution
+    cached: typing.Optional[bool]
+    # Seconds the resolution took
+    duration: float
+
+    def addrinfo(self, port: int) -> typing.List[tuple]:
+        """Returns the addresses with port like socket.getaddrinfo with SOCK_STREAM returns them"""
+        import socket
+
+        return [
+            (family, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (address[0], port, *address[2:]))
+            for family, address in self.addresses
+        ]
+
+
+class Resolver:
+    """Caching resolver for hostnames, safe to share between threads
+
+    getaddrinfo doesn't expose the TTL of records, so answers are cached for a fixed ttl and
+    names which don't exist for negative_ttl. Concurrent lookups of the same name wait for a single
+    resolution. With a path, the cache is shared with other processes through a file, new entries
+    are written to it by flush.
+    """
+
+    def __init__(self, ttl: float = 60, negative_ttl: float = 10, path: typing.Optional[str] = None):
+        """
+        :param ttl: Seconds addresses are cached, 0 disables caching
+        :param negative_ttl: Seconds a name which doesn't exist is cached
+        :param path: Optional path of a file the cache is persisted in
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._pending = {}
+        self._dirty = set()
+        self._flush_lock = threading.Lock()
+        self._mtime = None
+
+    def _read_entries(self):
+        entries = read_cache(self.path)
+        if not isinstance(entries, dict):
+            return {}
+        return {
+            key: entry for key, entry in entries.items()
+            if isinstance(entry, dict) and isinstance(entry.get("expires"), (int, float))
+        }
+
+    def _load(self):
+        # Only read if another process changed the file since it was read last
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        for key, entry in self._read_entries().items():
+            if entry["expires"] > self._entries.get(key, {"expires": 0})["expires"]:
+                self._entries[key] = entry
+
+    def flush(self):
+        """This method is used to write the entries resolved since the last flush to the cache file
+
+        The entries are merged with the ones other processes wrote, while the file is locked.
+        Called at exit for the resolver of get_resolver, call it after resolving a batch of names
+        to share them earlier.
+        """
+        if not self.path:
+            return
+        import fcntl
+
+        with self._flush_lock:
+            with self._lock:
+                dirty = {key: self._entries[key] for key in self._dirty if key in self._entries}
+                self._dirty.clear()
+            if not dirty:
+                return
+            try:
+                with open(f"{self.path}.lock", "a") as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    now = time.time()
+                    entries = {key: entry for key, entry in self._read_entries().items() if entry["expires"] > now}
+                    for key, entry in dirty.items():
+                        if entry["expires"] > entries.get(key, {"expires": now})["expires"]:
+                            entries[key] = entry
+                    write_cache(self.path, entries)
+            except OSError:
+                # The cache file is only an optimization
+                pass
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if (entry is None or entry["expires"] <= time.time()) and self.path:
+            self._load()
+            entry = self._entries.get(key)
+        return entry if entry is not None and entry["expires"] > time.time() else None
+
+    def resolve(self, host: str, family: int = 0) -> Resolution:
+        """This method is used to resolve a hostname to its IPv4 and IPv6 addresses
+
+        :param host: Hostname or IP address
+        :param family: socket.AF_INET or socket.AF_INET6 to only resolve one family, 0 for both
+        :return: Resolution
+        :raises socket.gaierror: If the name can't be resolved
+        """
+        import socket
+
+        start = time.monotonic()
+        # Checked with inet_pton, getaddrinfo imports the idna codec even for IP addresses
+        for literal_family, address in ((socket.AF_INET, (host, 0)), (socket.AF_INET6, (host, 0, 0, 0))):
+            try:
+                socket.inet_pton(literal_family, host)
+            except (OSError, ValueError):
+                continue
+            if family in (0, literal_family):
+                return Resolution(host, [(literal_family, address)], None, time.monotonic() - start)
+
+        key = f"{family}/{host.lower()}"
+        while True:
+            with self._lock:
+                entry = self._lookup(key)
+                if entry is None:
+                    pending = self._pending.get(key)
+                    if pending is None:
+                        self._pending[key] = threading.Event()
+                        break
+            if entry is not None:
+                if "error" in entry:
+                    raise socket.gaierror(*entry["error"])
+                addresses = [(x[0], tuple(x[1])) for x in entry["addresses"]]
+                return Resolution(host, addresses, True, time.monotonic() - start)
+            # Another thread resolves the name, its result is in the cache afterwards
+            pending.wait()
+
+        try:
+            infos = socket.getaddrinfo(host, 0, family, socket.SOCK_STREAM)
+            entry = {"expires": time.time() + self.ttl, "addresses": [[x[0], list(x[4])] for x in infos]}
+        except socket.gaierror as err:
+            # Only names which don't exist are cached, temporary failures are retried on the next lookup
+            if err.errno in (socket.EAI_NONAME, getattr(socket, "EAI_NODATA", None)):
+                entry = {"expires": time.time() + self.negative_ttl, "error": [err.errno, err.strerror]}
+            else:
+                entry = None
+            raise
+        finally:
+            with self._lock:
+                if self.ttl > 0 and entry is not None and entry["expires"] > time.time():
+                    self._entries[key] = entry
+                    self._dirty.add(key)
+                self._pending.pop(key).set()
+        return Resolution(host, [(x[0], x[4]) for x in infos], False, time.monotonic() - start)
+
+
+@functools.lru_cache(maxsize=None)
+def get_resolver() -> Resolver:
+    """This method is used to retrieve the resolver shared by all plugins of the process
+
+    It is configured with $Q_PLUGINS_DNS_TTL (default 60 seconds, 0 disables the cache),
+    $Q_PLUGINS_DNS_NEGATIVE_TTL (default 10 seconds) and $Q_PLUGINS_DNS_CACHE_FILE, the file
+    the cache is shared with other processes through. The file defaults to dns.json in the cache
+    directory, an empty value or a cache directory which can't be created only caches in memory.
+
+    :return: Resolver
+    """
+    path = os.environ.get("Q_PLUGINS_DNS_CACHE_FILE")
+    if path is None:
+        try:
+            path = os.path.join(cache_dir(), "dns.json")
+        except OSError:
+            path = None
+    resolver = Resolver(
+        ttl=float(os.environ.get("Q_PLUGINS_DNS_TTL", 60)),
+        negative_ttl=float(os.environ.get("Q_PLUGINS_DNS_NEGATIVE_TTL", 10)),
+        path=path or None
+    )
+    atexit.register(resolver.flush)
+    return resolver
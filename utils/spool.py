@@ -0,0 +1,152 @@
+import json
+import os
+import time
+import typing
+
+__all__ = ["Spool", "SpoolEntry", "build_digest"]
+
+
+class SpoolEntry(typing.NamedTuple):
+    id: int
+    group_key: str
+    payload: typing.Dict
+    created: float
+    attempts: int
+
+
+class Spool:
+    """Durable queue backed by a sqlite database
+
+    Entries are claimed for a lease time and only removed once they are acknowledged,
+    so every entry is delivered at least once even if the consumer crashes.
+    """
+
+    def __init__(self, directory: str, name: str):
+        import sqlite3
+
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.path = os.path.join(directory, f"{name}.sqlite")
+        self._db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        os.chmod(self.path, 0o600)
+        # With WAL, commits don't have to wait for a fsync, which keeps enqueue cheap
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS spool ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "group_key TEXT NOT NULL, "
+            "payload TEXT NOT NULL, "
+            "created REAL NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "available REAL NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS spool_available ON spool (available, id)")
+
+    def enqueue(self, payload: typing.Dict, group_key: str = ""):
+        """This method is used to append an entry to the spool
+
+        :param payload: JSON serializable payload
+        :param group_key: Key to group related entries, e.g. the recipient
+        """
+        self._db.execute(
+            "INSERT INTO spool (group_key, payload, created) VALUES (?, ?, ?)",
+            (group_key, json.dumps(payload), time.time())
+        )
+
+    def claim(self, limit: int, lease: float, window: float = 0) -> typing.List[SpoolEntry]:
+        """This method is used to claim the oldest available entries
+
+        Claimed entries are invisible to other consumers until the lease expires.
+
+        :param limit: Maximum number of entries to claim
+        :param lease: Seconds until the entries are available again, if not acknowledged
+        :param window: Only claim entries of groups whose oldest available entry is at least window seconds old,
+            so entries arriving within the window can be delivered together
+        :return: List of SpoolEntry
+        """
+        now = time.time()
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            if window > 0:
+                rows = self._db.execute(
+                    "SELECT id, group_key, payload, created, attempts FROM spool WHERE available <= ? "
+                    "AND group_key IN (SELECT group_key FROM spool WHERE available <= ? "
+                    "GROUP BY group_key HAVING MIN(created) <= ?) ORDER BY id LIMIT ?",
+                    (now, now, now - window, limit)
+                ).fetchall()
+            else:
+                rows = self._db.execute(
+                    "SELECT id, group_key, payload, created, attempts FROM spool WHERE available <= ? "
+                    "ORDER BY id LIMIT ?",
+                    (now, limit)
+                ).fetchall()
+            self._db.executemany(
+                "UPDATE spool SET available = ?, attempts = attempts + 1 WHERE id = ?",
+                [(now + lease, x[0]) for x in rows]
+            )
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        return [SpoolEntry(x[0], x[1], json.loads(x[2]), x[3], x[4] + 1) for x in rows]
+
+    def ack(self, ids: typing.Iterable[int]):
+        """This method is used to remove delivered entries
+
+        :param ids: IDs of the entries
+        """
+        self._db.executemany("DELETE FROM spool WHERE id = ?", [(x,) for x in ids])
+
+    def release(self, ids: typing.Iterable[int], delay: float = 0):
+        """This method is used to make claimed entries available again
+
+        :param ids: IDs of the entries
+        :param delay: Seconds until the entries become available
+        """
+        self._db.executemany("UPDATE spool SET available = ? WHERE id = ?", [(time.time() + delay, x) for x in ids])
+
+    def stats(self) -> typing.Dict:
+        """This method is used to retrieve the number of entries and the age of the oldest one
+
+        :return: dict with depth and age in seconds
+        """
+        depth, oldest = self._db.execute("SELECT COUNT(*), MIN(created) FROM spool").fetchone()
+        return {"depth": depth, "age": round(time.time() - oldest, 3) if oldest else 0}
+
+    def close(self):
+        self._db.close()
+
+
+def build_digest(messages: typing.List[str], limit: int) -> str:
+    """This method is used to merge multiple notifications into a single one
+
+    Identical messages are only listed once with their count. Messages not fitting
+    into limit characters are left out and counted at the end.
+
+    :param messages: Messages in the order they arrived
+    :param limit: Maximum length of the digest
+    :return: The digest or the message itself, if there is only one
+    """
+    if len(messages) == 1:
+        return messages[0][:limit]
+    counts = {}
+    for message in messages:
+        counts[message] = counts.get(message, 0) + 1
+    lines = [f"{len(messages)} notifications:"]
+    length = len(lines[0])
+    listed = 0
+    # Space reserved for the footer, it never gets longer than this
+    reserve = len(f"\n... and {len(messages)} more")
+    for index, (message, count) in enumerate(counts.items()):
+        line = f"{count}x {message}" if count > 1 else message
+        is_last = index == len(counts) - 1
+        if not listed:
+            # At least a part of the first message is always included
+            line = line[:max(limit - length - 1 - (0 if is_last else reserve), 0)]
+        if length + 1 + len(line) + (0 if is_last else reserve) > limit:
+            lines.append(f"... and {len(messages) - listed} more")
+            break
+        lines.append(line)
+        length += 1 + len(line)
+        listed += count
+    return "\n".join(lines)[:limit]
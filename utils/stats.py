@@ -0,0 +1,113 @@
+import array
+import itertools
+import math
+import typing
+
+__all__ = ["LatencyHistogram"]
+
+
+class LatencyHistogram:
+    """Histogram of latencies with logarithmic buckets and memory independent of the number of values
+
+    Bucket bounds grow by the factor 1 + precision, so percentiles and bucket counts have a relative
+    error of at most precision. Values below lowest and above highest are counted in the first
+    and last bucket. Count, mean, min and max are exact.
+    """
+
+    def __init__(self, lowest: float = 0.001, highest: float = 600000.0, precision: float = 0.01):
+        """
+        :param lowest: Upper bound of the first bucket
+        :param highest: Lower bound of the last bucket
+        :param precision: Maximum relative error
+        """
+        self.lowest = lowest
+        self.precision = precision
+        self._log_base = math.log1p(precision)
+        self._last = int(math.log(highest / lowest) / self._log_base) + 1
+        self._counts = array.array("Q", [0]) * (self._last + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _index(self, value: float) -> int:
+        if value <= self.lowest:
+            return 0
+        return min(int(math.log(value / self.lowest) / self._log_base) + 1, self._last)
+
+    def _upper(self, index: int) -> float:
+        return self.lowest * (1 + self.precision) ** index
+
+    def record(self, value: float):
+        """This method is used to add a value to the histogram
+
+        :param value: Value to add
+        """
+        self._counts[self._index(value)] += 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "LatencyHistogram"):
+        """This method is used to add the values of a histogram with the same bounds and precision
+
+        :param other: Histogram to add
+        """
+        if (other.lowest, other.precision, other._last) != (self.lowest, self.precision, self._last):
+            raise ValueError("Histograms with different buckets can't be merged")
+        for index, count in enumerate(other._counts):
+            if count:
+                self._counts[index] += count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self) -> typing.Optional[float]:
+        return self.sum / self.count if self.count else None
+
+    def percentiles(self, percentiles: typing.Iterable[float]) -> typing.List[typing.Optional[float]]:
+        """This method is used to retrieve percentiles of the values
+
+        :param percentiles: Percentiles between 0 and 100
+        :return: The percentiles in the same order or None if the histogram is empty
+        """
+        return self.values_at_ranks([max(math.ceil(p / 100 * self.count), 1) for p in percentiles])
+
+    def values_at_ranks(self, ranks: typing.Iterable[int]) -> typing.List[typing.Optional[float]]:
+        """This method is used to retrieve the values at ranks, e.g. rank 1 is the smallest value
+
+        :param ranks: Ranks between 1 and count
+        :return: The values in the same order or None for ranks outside of the recorded values
+        """
+        ranks = list(ranks)
+        results = [None] * len(ranks)
+        cumulative = itertools.accumulate(self._counts)
+        index, seen = 0, next(cumulative)
+        for rank, position in sorted((rank, i) for i, rank in enumerate(ranks) if 1 <= rank <= self.count):
+            while seen < rank:
+                index, seen = index + 1, next(cumulative)
+            # The upper bound of the bucket is at most precision above the value, but never outside of min and max
+            results[position] = min(max(self._upper(index), self.min), self.max)
+        return results
+
+    def percentile(self, percentile: float) -> typing.Optional[float]:
+        """This method is used to retrieve a percentile of the values
+
+        :param percentile: Percentile between 0 and 100
+        :return: The percentile or None if the histogram is empty
+        """
+        return self.percentiles([percentile])[0]
+
+    def count_below(self, bounds: typing.Iterable[float]) -> typing.List[int]:
+        """This method is used to retrieve cumulative bucket counts, e.g. for a histogram of Prometheus
+
+        :param bounds: Upper bounds
+        :return: Number of values less than or equal to every bound
+        """
+        cumulative = list(itertools.accumulate(self._counts))
+        return [cumulative[self._index(bound)] for bound in bounds]